@@ -0,0 +1,143 @@
+"""JSON API for the flows, generated from each FSM model's `fsm`.
+
+All the endpoints work for the logged in user's roles, as the HTML views do. Lists use keyset
+pagination (`?after=<last pk>`), and the export streams all the rows as JSON lines.
+"""
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.fields.files import FieldFile
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.generic.edit import View
+
+from core import forms, loading, transitions
+
+# default and maximum amount of flows per page in the lists
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# rows fetched from the database at a time when streaming
+CHUNK_SIZE = 2000
+
+# what is shown for each flow in the lists
+LIST_FIELDS = ('pk', 'state', 'version')
+
+
+def _step_info(step):
+    return {'index': step.index, 'next_state': step.next_state, 'fields': list(step.fields)}
+
+
+def serialize(instance):
+    """Return a JSON-able dict with all the info of a flow instance."""
+    data = {'pk': instance.pk}
+    for field in instance._meta.concrete_fields:
+        if field.is_relation and field.remote_field.parent_link:
+            continue
+        value = getattr(instance, field.attname)
+        if isinstance(value, FieldFile):
+            value = value.name or None
+        data[field.attname] = value
+    for field in instance._meta.many_to_many:
+        data[field.name] = [obj.pk for obj in getattr(instance, field.name).all()]
+    for name, _ in loading.get_load_plan(type(instance)).totals:
+        data[name] = getattr(instance, name, None)
+    return data
+
+
+class APIView(View):
+    """Base for the API views: JSON errors instead of login redirects."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': "Authentication required"}, status=401)
+        return super().dispatch(request, *args, **kwargs)
+
+
+class FlowList(APIView):
+    """The flows of a model that the user's roles can work on, in pk order."""
+
+    def get(self, request, fsmmodel):
+        try:
+            after = int(request.GET.get('after', 0))
+            limit = min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error': "after and limit must be integers"}, status=400)
+        if limit < 1:
+            return JsonResponse({'error': "limit must be at least 1"}, status=400)
+
+        rows = list(
+            fsmmodel.objects.actionable_by(*request.roles).filter(pk__gt=after).order_by('pk')
+            .values(*LIST_FIELDS)[:limit + 1])
+        next_url = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_url = '{}?after={}&limit={}'.format(
+                reverse('api_flow_list', kwargs={'fsmmodel': fsmmodel}), rows[-1]['pk'], limit)
+        return JsonResponse({'results': rows, 'next': next_url})
+
+
+class FlowExport(APIView):
+    """All the flows of a model that the user's roles can work on, streamed as JSON lines."""
+
+    def get(self, request, fsmmodel):
+        rows = fsmmodel.objects.actionable_by(*request.roles).order_by('pk').values(*LIST_FIELDS)
+
+        def lines():
+            for row in rows.iterator(chunk_size=CHUNK_SIZE):
+                yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+
+class FlowDetail(APIView):
+    """A flow with all its info, and the steps the user's roles can do on it."""
+
+    def get(self, request, fsmmodel, pk):
+        instance = get_object_or_404(loading.detail_queryset(fsmmodel), pk=pk)
+        data = serialize(instance)
+        data['steps'] = [
+            _step_info(step)
+            for step in fsmmodel.get_steps_for_roles(instance.state, request.roles)]
+        return JsonResponse(data)
+
+
+class FlowStep(APIView):
+    """Do a step on a flow (or create one): POST the step's fields as a JSON object.
+
+    Include the "version" got with the flow to make sure nobody changed it meanwhile.
+    """
+
+    def post(self, request, fsmmodel, step_index, pk=None):
+        try:
+            step = fsmmodel.get_step_by_index(step_index)
+        except IndexError:
+            return JsonResponse({'error': "Unknown step"}, status=404)
+        if step.role not in request.roles or (pk is None) != (step.current_state is None):
+            return JsonResponse({'error': "Not allowed"}, status=403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': "Invalid JSON"}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'error': "A JSON object is needed"}, status=400)
+        version = data.get('version')
+        if version is not None and not isinstance(version, int):
+            return JsonResponse({'error': "version must be an integer"}, status=400)
+
+        instance = None if pk is None else get_object_or_404(fsmmodel, pk=pk)
+        form = forms.get_step_form_class(fsmmodel, step.index)(data, instance=instance)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+        try:
+            if instance is not None and instance.state != step.current_state:
+                raise transitions.TransitionConflict(
+                    "{} {} is in state {!r}".format(fsmmodel.__name__, pk, instance.state))
+            obj = transitions.apply_step(step, form, request.user, version)
+        except transitions.TransitionConflict as err:
+            return JsonResponse({'error': str(err)}, status=409)
+
+        obj = loading.detail_queryset(fsmmodel).get(pk=obj.pk)
+        return JsonResponse(serialize(obj), status=201 if pk is None else 200)
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from core import checks, registry, roles  # NOQA: importing them registers their hooks
+        from core import search, transitions
+        registry.populate()
+        search.connect()
+        transitions.connect()
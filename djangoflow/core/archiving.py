@@ -0,0 +1,95 @@
+"""Move the finished flows out of the hot tables, into the archive ones.
+
+Incomes in a final state for longer than FLOW_ARCHIVE_AFTER_DAYS are copied, with their
+payments, extra documents and history, to IncomeArchive, PaymentArchive and
+TransitionArchive (keeping their pks), and deleted from the hot tables. Each batch is
+moved in its own transaction, so an interrupted run leaves nothing half moved, and running
+it again just goes on with the flows that are left.
+
+The archived rows are read with `IncomeArchive.objects` (read only), and
+`IncomeArchive.objects.union_hot()` reads both the hot and the archived ones.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from core.models import (
+    Income, IncomeArchive, PaymentArchive, PaymentReceived, PendingNotification, Transition,
+    TransitionArchive,
+)
+
+# how many flows are moved per transaction
+BATCH_SIZE = 500
+
+
+def _copy(archive_model, rows, **extra):
+    # the archive fields have the same names as the originals
+    names = [
+        field.attname for field in archive_model._meta.concrete_fields
+        if field.attname not in extra]
+    return [archive_model(**{name: row[name] for name in names}, **extra) for row in rows]
+
+
+def get_archivable(older_than=None):
+    """Return a queryset of the incomes that are finished since before `older_than` ago.
+
+    Flows with notifications still pending are left for later.
+    """
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'FLOW_ARCHIVE_AFTER_DAYS', 365))
+    finished = Transition.objects.filter(
+        model='Income', object_pk=OuterRef('pk')).order_by('-time').values('time')[:1]
+    pending = PendingNotification.objects.filter(
+        transition__model='Income').values('transition__object_pk')
+    # flows without history are from before it was recorded, so they are old
+    return Income.objects.filter(
+        state__in=sorted(Income._fsm_table.final_states),
+    ).annotate(finished=Subquery(finished)).filter(
+        Q(finished__lt=timezone.now() - older_than) | Q(finished=None),
+    ).exclude(pk__in=pending)
+
+
+def archive_batch(pks):
+    """Move the incomes (and all their related rows) to the archive; return how many."""
+    now = timezone.now()
+    with transaction.atomic():
+        incomes = list(
+            Income.objects.filter(pk__in=pks).select_for_update().values(
+                'pk', *[field.attname for field in IncomeArchive._meta.concrete_fields
+                        if field.attname not in ('id', 'archived')]))
+        for row in incomes:
+            row['id'] = row.pop('pk')
+        pks = [row['id'] for row in incomes]
+        IncomeArchive.objects.bulk_create(_copy(IncomeArchive, incomes, archived=now))
+
+        docs = Income.extra_docs.through.objects.filter(income_id__in=pks)
+        IncomeArchive.extra_docs.through.objects.bulk_create(
+            IncomeArchive.extra_docs.through(incomearchive_id=income_id, extradocument_id=doc_id)
+            for income_id, doc_id in docs.values_list('income_id', 'extradocument_id'))
+        payments = PaymentReceived.objects.filter(income_id__in=pks)
+        PaymentArchive.objects.bulk_create(_copy(PaymentArchive, payments.values()))
+        history = Transition.objects.filter(model='Income', object_pk__in=pks)
+        TransitionArchive.objects.bulk_create(_copy(TransitionArchive, history.values()))
+
+        # the payments (and the extra documents links) go with their incomes
+        history.delete()
+        Income.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def archive(older_than=None, batch_size=BATCH_SIZE, max_batches=None):
+    """Archive all the incomes finished long ago, in batches; return how many."""
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        pks = list(
+            get_archivable(older_than).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        total += archive_batch(pks)
+        batches += 1
+    return total
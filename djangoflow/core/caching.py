@@ -0,0 +1,67 @@
+"""Cached fragments of the home page, on Django's cache framework.
+
+The "create" list only depends on the role and the FSM definitions, so it's cached
+forever. The "open" list changes whenever a flow changes state, so it's cached under a
+version that is bumped after every transition is committed.
+"""
+
+import time
+from collections import Counter
+
+from django.core.cache import cache
+
+from core import registry
+
+# how long an open list is kept (it's also dropped, in practice, with each version bump)
+OPEN_TIMEOUT = 60 * 60
+
+OPEN_VERSION_KEY = 'flow:home:open-version'
+
+_stats = Counter()
+
+
+def _get_or_build(kind, key, build, timeout):
+    value = cache.get(key)
+    if value is None:
+        _stats[kind + '_misses'] += 1
+        value = build()
+        cache.set(key, value, timeout)
+    else:
+        _stats[kind + '_hits'] += 1
+    return value
+
+
+def create_fragment(role, build):
+    """Return the cached create list for the role, using `build()` to make it if needed."""
+    key = 'flow:home:create:{}:{}'.format(registry.get_signature(), role)
+    return _get_or_build('create', key, build, None)
+
+
+def get_open_version():
+    # not a counter starting from 1, so a lost (evicted) version is never reused
+    return cache.get_or_set(OPEN_VERSION_KEY, time.time_ns, None)
+
+
+def bump_open_version():
+    """Invalidate all the cached open lists; call it when a transition is committed."""
+    try:
+        cache.incr(OPEN_VERSION_KEY)
+    except ValueError:
+        cache.set(OPEN_VERSION_KEY, time.time_ns(), None)
+
+
+def open_fragment(role, page, build):
+    """Return the cached open list page for the role, using `build()` to make it if needed."""
+    key = 'flow:home:open:{}:{}:{}'.format(get_open_version(), role, page)
+    return _get_or_build('open', key, build, OPEN_TIMEOUT)
+
+
+def get_stats():
+    """Return the hits and misses of each kind of fragment, in this process."""
+    stats = dict.fromkeys(['create_hits', 'create_misses', 'open_hits', 'open_misses'], 0)
+    stats.update(_stats)
+    return stats
+
+
+def reset_stats():
+    _stats.clear()
@@ -0,0 +1,71 @@
+"""System checks of the FSM models, run by `manage.py check` (and before serving).
+
+The `fsm` structure is validated when each model class is created (see `core.fsm`); these
+checks need the model's fields, so they run once all the models are loaded: the states
+must be choices of the `state` field, the step fields must exist, and every state reached
+must lead somewhere.
+"""
+
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
+
+from core import registry
+from core.fsm import can_finish
+
+
+def check_model(model):
+    """Return the checks messages for a FSM model."""
+    table = model._fsm_table
+    errors = []
+    try:
+        choices = {state for state, _ in model._meta.get_field('state').flatchoices}
+    except FieldDoesNotExist:
+        return [checks.Error("FSM models need a 'state' field", obj=model, id='core.E001')]
+
+    for step in table.steps:
+        for state in (step.current_state, step.next_state):
+            if state is not None and state not in choices:
+                errors.append(checks.Error(
+                    "fsm[{}] uses the state {!r}, which is not in the state choices".format(
+                        step.index, state), obj=model, id='core.E002'))
+        for name in step.fields:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                errors.append(checks.Error(
+                    "fsm[{}] works on {!r}, which is not a field of the model".format(
+                        step.index, name), obj=model, id='core.E003'))
+                continue
+            if not field.concrete or not field.editable:
+                errors.append(checks.Warning(
+                    "fsm[{}] works on {!r}, which can't be edited in the step form, so "
+                    "it's left out of it".format(
+                        step.index, name), obj=model, id='core.W001'))
+        if step.current_state is not None and step.current_state not in table.reachable:
+            errors.append(checks.Error(
+                "fsm[{}] leaves the state {!r}, which can't be reached".format(
+                    step.index, step.current_state), obj=model, id='core.E004'))
+
+    for state in sorted(table.reachable - table.final_states - set(table.roles_by_state)):
+        errors.append(checks.Error(
+            "The state {!r} is a dead end, but it's not a final state".format(state),
+            obj=model, id='core.E005'))
+    finishing = can_finish(table)
+    for state in sorted(table.reachable & set(table.roles_by_state) - finishing):
+        errors.append(checks.Warning(
+            "No final state can be reached from the state {!r}".format(state),
+            obj=model, id='core.W002'))
+    for state in sorted(choices - table.reachable):
+        errors.append(checks.Warning(
+            "The state {!r} is never reached by the fsm".format(state),
+            obj=model, id='core.W003'))
+    return errors
+
+
+@checks.register(checks.Tags.models)
+def check_fsm_models(app_configs=None, **kwargs):
+    errors = []
+    for model in registry.get_models():
+        if app_configs is None or model._meta.app_config in app_configs:
+            errors.extend(check_model(model))
+    return errors
@@ -0,0 +1,18 @@
+from core import registry
+
+
+class FSMModelConverter:
+    """Resolve a FSM model name in the URL to the model class (unknown names don't match)."""
+
+    regex = '[A-Za-z_][A-Za-z0-9_]*'
+
+    def to_python(self, value):
+        try:
+            return registry.get_model(value)
+        except LookupError:
+            raise ValueError(value)
+
+    def to_url(self, value):
+        if isinstance(value, str):
+            return value
+        return value.__name__
@@ -0,0 +1,145 @@
+"""Export the flows and their history as CSV or JSON lines, streamed.
+
+The rows come from `values_list()` queries (the related names are joined by the
+database, no model instances are built) read with `iterator()`, and are encoded one by
+one, so the memory used doesn't depend on how many there are.
+
+The columns of each FSM model are its `fsm_export` ((header, lookup) pairs), or all its
+concrete fields if it has none.
+"""
+
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from core import registry
+from core.models import Transition
+
+# rows fetched from the database at a time
+CHUNK_SIZE = 2000
+
+FORMATS = ('csv', 'jsonl')
+
+KINDS = ('flows', 'history')
+
+HISTORY_COLUMNS = (
+    ('model', 'model'),
+    ('pk', 'object_pk'),
+    ('from_state', 'from_state'),
+    ('to_state', 'to_state'),
+    ('step', 'step_index'),
+    ('user', 'user__username'),
+    ('time', 'time'),
+)
+
+
+def get_columns(model):
+    """Return the (header, lookup) pairs exported for the FSM model."""
+    columns = getattr(model, 'fsm_export', None)
+    if columns is None:
+        columns = [('pk', 'pk')] + [
+            (field.attname, field.attname) for field in model._meta.concrete_fields
+            if not (field.is_relation and field.remote_field.parent_link)]
+    return tuple(columns) + (('created', 'created'),)
+
+
+def _start_of(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+def _date_range(queryset, field, since, until):
+    # both days included, in the current time zone
+    if since is not None:
+        queryset = queryset.filter(**{field + '__gte': _start_of(since)})
+    if until is not None:
+        queryset = queryset.filter(**{field + '__lt': _start_of(until + timedelta(days=1))})
+    return queryset
+
+
+def flow_rows(model, state=None, since=None, until=None):
+    """Return the headers and an iterator of rows of the model's flows.
+
+    The dates filter by when the flows were created (their first transition).
+    """
+    created = Transition.objects.filter(
+        model=model.__name__, object_pk=OuterRef('pk'), from_state=None).values('time')[:1]
+    queryset = model.objects.annotate(created=Subquery(created)).order_by('pk')
+    if state is not None:
+        queryset = queryset.filter(state=state)
+    queryset = _date_range(queryset, 'created', since, until)
+    columns = get_columns(model)
+    rows = queryset.values_list(*[lookup for _, lookup in columns])
+    return [header for header, _ in columns], rows.iterator(chunk_size=CHUNK_SIZE)
+
+
+def history_rows(model=None, state=None, since=None, until=None):
+    """Return the headers and an iterator of rows of the transitions (of a model, if given).
+
+    The state filters by the state they moved to.
+    """
+    queryset = Transition.objects.order_by('time', 'pk')
+    if model is not None:
+        queryset = queryset.filter(model=model.__name__)
+    if state is not None:
+        queryset = queryset.filter(to_state=state)
+    queryset = _date_range(queryset, 'time', since, until)
+    rows = queryset.values_list(*[lookup for _, lookup in HISTORY_COLUMNS])
+    return [header for header, _ in HISTORY_COLUMNS], rows.iterator(chunk_size=CHUNK_SIZE)
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError("Invalid date {!r}, use YYYY-MM-DD".format(value))
+    return date
+
+
+def get_rows(kind, model_name=None, state=None, since=None, until=None):
+    """Return the headers and rows of an export, from its (text) options.
+
+    ValueError is raised for invalid options.
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown export {!r}, use one of {}".format(kind, KINDS))
+    model = None
+    if model_name:
+        try:
+            model = registry.get_model(model_name)
+        except LookupError as err:
+            raise ValueError(err)
+    elif kind == 'flows':
+        raise ValueError("The model of the flows is needed")
+    if state and model is not None and state not in dict(model._meta.get_field('state').choices):
+        raise ValueError("{} has no state {!r}".format(model.__name__, state))
+    filters = {
+        'state': state or None, 'since': _parse_date(since), 'until': _parse_date(until)}
+    if kind == 'flows':
+        return flow_rows(model, **filters)
+    return history_rows(model, **filters)
+
+
+class _Echo:
+    # a file for csv.writer that just gives back what is written
+    def write(self, value):
+        return value
+
+
+def encode(headers, rows, format):
+    """Yield the rows as lines of text in the format (with the headers first, for CSV)."""
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(headers)
+        for row in rows:
+            yield writer.writerow(row)
+    elif format == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder) + '\n'
+    else:
+        raise ValueError("Unknown format {!r}, use one of {}".format(format, FORMATS))
@@ -0,0 +1,209 @@
+"""Cache of the ModelForm classes used by the flow views.
+
+Building a form class goes through the whole ModelForm metaclass machinery, and they only
+depend on the model and its `fsm`, so each one is built once (the first time it's needed)
+and reused by all the following requests.
+
+Related fields in the step forms never render their whole choices list: they only render
+the chosen values and search the others as you type (see `core.views.FlowLookup`).
+"""
+
+from functools import lru_cache
+
+from django.db.models import ImageField
+from django.forms import Select, SelectMultiple, Widget, models as model_forms
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
+
+from core import storage
+
+
+def _disabled_formfield(db_field, **kwargs):
+    return db_field.formfield(disabled=True, **kwargs)
+
+
+class ReadOnlyText(Widget):
+    """Just show a text, there is nothing to edit."""
+
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+    def render(self, name, value, attrs=None, renderer=None):
+        return format_html('<span>{}</span>', self.text)
+
+
+def _summary(obj):
+    # the object, with the thumbnails of its images linking to their previews
+    images = [
+        getattr(obj, field.name) for field in obj._meta.concrete_fields
+        if isinstance(field, ImageField)]
+    return format_html('{}{}', obj, format_html_join('', ' <a href="{}"><img src="{}"></a>', [
+        (storage.derivative_url(image, 'preview'), storage.derivative_url(image, 'thumb'))
+        for image in images if image]))
+
+
+class InstanceSummaryForm(model_forms.ModelForm):
+    """Read only form with all the info of an instance.
+
+    Related objects are shown from the instance itself (load it with
+    `core.loading.detail_queryset`), never rendering their whole choices list, and their
+    images as thumbnails (never the originals).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, field in self.fields.items():
+            if isinstance(field, model_forms.ModelMultipleChoiceField):
+                if self.instance.pk is None:
+                    text = ""
+                else:
+                    text = format_html_join(", ", "{}", (
+                        (_summary(obj),) for obj in getattr(self.instance, name).all()))
+            elif isinstance(field, model_forms.ModelChoiceField):
+                # (a new instance may not have them set yet)
+                attname = self.instance._meta.get_field(name).attname
+                obj = getattr(self.instance, name) if getattr(self.instance, attname) else None
+                text = "" if obj is None else _summary(obj)
+            else:
+                continue
+            field.widget = ReadOnlyText(text)
+
+
+class LookupMixin:
+    """Only render the chosen options; the others are searched from the lookup url."""
+
+    class Media:
+        js = ['core/lookup.js']
+
+    def __init__(self, url, scope=None, attrs=None):
+        super().__init__(attrs)
+        self.url = url
+        self.scope = scope
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        attrs = super().build_attrs(base_attrs, extra_attrs)
+        attrs['data-lookup-url'] = self.url
+        if self.scope is not None:
+            attrs['data-lookup-scope'] = self.scope
+        return attrs
+
+    def optgroups(self, name, value, attrs=None):
+        chosen = {str(item) for item in value if item not in ('', None)}
+        options = []
+        if not self.allow_multiple_selected:
+            options.append(self.create_option(name, '', self.choices.field.empty_label or '',
+                                              not chosen, 0))
+        if chosen:
+            for obj in self.choices.queryset.filter(pk__in=chosen):
+                option_value = self.choices.field.prepare_value(obj)
+                options.append(self.create_option(
+                    name, option_value, self.choices.field.label_from_instance(obj), True,
+                    len(options), attrs=attrs))
+        return [(None, options, 0)]
+
+
+class LookupSelect(LookupMixin, Select):
+    pass
+
+
+class LookupSelectMultiple(LookupMixin, SelectMultiple):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_lookup_scopes(model):
+    """Return which related fields are limited by another field of the same step.
+
+    It's {field: (remote_field, local_field)}: the options for `field` must have their
+    `remote_field` equal to the value chosen in `local_field` (e.g. the Income category
+    must be from the chosen event, because both Income and Category point to Event).
+    """
+    scopes = {}
+    for step in model._fsm_table.steps:
+        targets = {}
+        for name in step.fields:
+            field = model._meta.get_field(name)
+            if field.many_to_one or field.one_to_one:
+                targets.setdefault(field.related_model, name)
+        for name in step.fields:
+            field = model._meta.get_field(name)
+            if not field.is_relation or not field.concrete:
+                continue
+            for remote in field.related_model._meta.concrete_fields:
+                local = targets.get(remote.related_model) if remote.many_to_one else None
+                if local is not None and local != name:
+                    scopes[name] = (remote.name, local)
+                    break
+    return scopes
+
+
+class StepForm(model_forms.ModelForm):
+    """The fields to work on in a step, checking the scopes of its related fields."""
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for name, (remote, local) in get_lookup_scopes(self._meta.model).items():
+            if name not in self.fields or local not in self.fields:
+                continue
+            chosen = cleaned_data.get(name)
+            scope = cleaned_data.get(local)
+            if chosen is None or scope is None:
+                continue
+            objs = chosen.all() if hasattr(chosen, 'all') else [chosen]
+            if any(getattr(obj, obj._meta.get_field(remote).attname) != scope.pk
+                   for obj in objs):
+                self.add_error(name, "It doesn't belong to the chosen {}.".format(local))
+        return cleaned_data
+
+
+def _lookup_formfield_callback(model):
+    scopes = get_lookup_scopes(model)
+
+    def formfield(db_field, **kwargs):
+        if db_field.is_relation and db_field.concrete:
+            url = reverse('flow_lookup', kwargs={'fsmmodel': model, 'field': db_field.name})
+            scope = scopes.get(db_field.name, (None, None))[1]
+            widget_class = LookupSelectMultiple if db_field.many_to_many else LookupSelect
+            kwargs['widget'] = widget_class(url, scope)
+        return db_field.formfield(**kwargs)
+
+    return formfield
+
+
+def get_form_fields(model, step):
+    """Return the fields of the step that can be edited in a form.
+
+    The others (e.g. reverse relations, like the payments of an Income) are worked on
+    outside the flow, the step only moves the instance on (see the core.W001 check).
+    """
+    editable = []
+    for name in step.fields:
+        field = model._meta.get_field(name)
+        if field.concrete and field.editable:
+            editable.append(name)
+    return editable
+
+
+@lru_cache(maxsize=None)
+def get_step_form_class(model, step_index):
+    """Return the form class with the fields to work on in the given step of the model."""
+    step = model.get_step_by_index(step_index)
+    return model_forms.modelform_factory(
+        model, form=StepForm, fields=get_form_fields(model, step),
+        formfield_callback=_lookup_formfield_callback(model))
+
+
+@lru_cache(maxsize=None)
+def get_instance_form_class(model):
+    """Return the read only form class to show all the info of an instance so far."""
+    return model_forms.modelform_factory(
+        model, form=InstanceSummaryForm, fields='__all__',
+        formfield_callback=_disabled_formfield)
+
+
+def clear_cache():
+    """Forget all the built form classes."""
+    get_step_form_class.cache_clear()
+    get_instance_form_class.cache_clear()
+    get_lookup_scopes.cache_clear()
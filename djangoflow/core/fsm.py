@@ -0,0 +1,126 @@
+"""Compilation of the `fsm` definitions of FSMModel subclasses into lookup tables."""
+
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.core.exceptions import ImproperlyConfigured
+
+Step = namedtuple('Step', "index current_state role next_state fields")
+
+# everything the flow views need from a `fsm` definition, prebuilt and read only:
+# - steps: all the Step objects, in definition order (so the index is the position)
+# - by_state_role: (state, role) -> tuple of Steps that can be done there
+# - roles_by_state: state -> frozenset of roles that need to work on that state
+# - states_by_role: role -> frozenset of states (never None) where it has work to do
+# - create_roles: frozenset of roles that can create a new instance
+# - final_states: frozenset of states that close the flow
+# - reachable: frozenset of states that can be reached from the None state
+TransitionTable = namedtuple('TransitionTable', (
+    "steps by_state_role roles_by_state states_by_role create_roles final_states "
+    "reachable"))
+
+
+def _reachable(steps, start):
+    # breadth first traversal of the steps' graph
+    next_states = {}
+    for step in steps:
+        next_states.setdefault(step.current_state, set()).add(step.next_state)
+    reached = set()
+    pending = [start]
+    while pending:
+        for state in next_states.get(pending.pop(), ()):
+            if state not in reached:
+                reached.add(state)
+                pending.append(state)
+    return reached
+
+
+def compile_fsm(name, fsm, final_state):
+    """Validate a `fsm` definition and build its TransitionTable.
+
+    Raise ImproperlyConfigured on malformed definitions, so they are found when the model
+    class is created and not while serving a request.
+    """
+    steps = []
+    by_state_role = {}
+    roles_by_state = {}
+    states_by_role = {}
+    for index, node in enumerate(fsm):
+        try:
+            current_state, role, next_state, fields = node
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured(
+                "{}.fsm[{}] must be (current_state, role, next_state, fields), got {!r}".format(
+                    name, index, node))
+        if isinstance(fields, str):
+            raise ImproperlyConfigured(
+                "{}.fsm[{}] fields must be a list of field names, got {!r}".format(
+                    name, index, fields))
+        if next_state is None:
+            raise ImproperlyConfigured(
+                "{}.fsm[{}] goes to the None state (that is before the creation); close "
+                "the flow with a state in fsm_final_state instead".format(name, index))
+        step = Step(
+            index=index, current_state=current_state, role=role,
+            next_state=next_state, fields=tuple(fields))
+        steps.append(step)
+        by_state_role.setdefault((current_state, role), []).append(step)
+        roles_by_state.setdefault(current_state, set()).add(role)
+        if current_state is not None:
+            states_by_role.setdefault(role, set()).add(current_state)
+
+    create_roles = frozenset(roles_by_state.get(None, ()))
+    if not create_roles:
+        raise ImproperlyConfigured(
+            "{}.fsm has no step from the None state, so it can never be created".format(name))
+
+    if final_state is None:
+        raise ImproperlyConfigured("{} must define fsm_final_state".format(name))
+    if isinstance(final_state, str):
+        final_states = frozenset([final_state])
+    else:
+        final_states = frozenset(final_state)
+    reached = _reachable(steps, None)
+    for state in final_states:
+        if state not in reached:
+            raise ImproperlyConfigured(
+                "{}.fsm never reaches the final state {!r}".format(name, state))
+        if state in roles_by_state:
+            raise ImproperlyConfigured(
+                "{}.fsm has steps leaving the final state {!r}".format(name, state))
+
+    return TransitionTable(
+        steps=tuple(steps),
+        by_state_role=MappingProxyType(
+            {key: tuple(value) for key, value in by_state_role.items()}),
+        roles_by_state=MappingProxyType(
+            {key: frozenset(value) for key, value in roles_by_state.items()}),
+        states_by_role=MappingProxyType(
+            {key: frozenset(value) for key, value in states_by_role.items()}),
+        create_roles=create_roles,
+        final_states=final_states,
+        reachable=frozenset(reached),
+    )
+
+
+def can_finish(table):
+    """Return the states (None included) from where some final state can be reached."""
+    return {
+        state for state in {None} | table.reachable
+        if state in table.final_states or _reachable(table.steps, state) & table.final_states}
+
+
+def to_dot(name, table):
+    """Return the Graphviz (DOT) description of a TransitionTable."""
+    def quote(state):
+        return '"{}"'.format(str(state).replace('"', '\\"'))
+
+    lines = ['digraph {} {{'.format(quote(name)), '    rankdir=LR;', '    "None" [shape=point];']
+    for state in sorted(table.final_states):
+        lines.append('    {} [shape=doublecircle];'.format(quote(state)))
+    for step in table.steps:
+        label = "{}: {}\\n{}".format(step.index, step.role, ", ".join(step.fields))
+        lines.append('    {} -> {} [label={}];'.format(
+            quote(step.current_state), quote(step.next_state), quote(label)))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
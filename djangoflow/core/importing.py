@@ -0,0 +1,215 @@
+"""Import events, sponsors, categories and incomes from CSV or JSON lines files.
+
+The rows are read as a stream and written in batches, so the files can be as big as
+needed. The related objects are referenced by name, resolved with maps loaded once (and
+updated as rows are created), and every row is matched by its natural key, so importing
+the same file again changes nothing:
+
+- events and sponsors: name
+- categories: event and name (the amount is updated if it changed)
+- incomes: event, sponsor and category (existing ones are left in their state)
+"""
+
+import csv
+import json
+from collections import namedtuple
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from core.models import Category, Event, Income, Sponsor
+from core.transitions import record_transitions, recorded_saves
+
+# how many rows are written per transaction
+BATCH_SIZE = 1000
+
+# the outcome of an import: how many rows created/updated/unchanged, and line -> why for
+# the rows that couldn't be imported
+ImportResult = namedtuple('ImportResult', "created updated unchanged failed")
+
+FORMATS = ('csv', 'jsonl')
+
+
+def read_rows(fh, format):
+    """Yield (line number, row dict) for each row of the open file, in the given format.
+
+    Lines that can't be read as a row give a ValueError (saying why) instead of the dict,
+    so the importers report them as failed.
+    """
+    if format == 'csv':
+        # the header is line 1
+        yield from enumerate(csv.DictReader(fh), 2)
+    elif format == 'jsonl':
+        for line_number, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as err:
+                row = ValueError("invalid JSON: {}".format(err))
+            else:
+                if not isinstance(row, dict):
+                    row = ValueError("not a JSON object")
+            yield line_number, row
+    else:
+        raise ValueError("Unknown format {!r}, use one of {}".format(format, FORMATS))
+
+
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _readable(batch, failed):
+    # the rows of the batch, recording the ones that couldn't be read as failed
+    for line_number, row in batch:
+        if isinstance(row, ValueError):
+            failed[line_number] = str(row)
+        else:
+            yield line_number, row
+
+
+def _get(row, name):
+    value = row.get(name)
+    if value is None or str(value).strip() == '':
+        raise ValueError("missing {!r}".format(name))
+    return str(value).strip()
+
+
+def _ref(names_map, row, name):
+    value = _get(row, name)
+    try:
+        return names_map[value]
+    except KeyError:
+        raise ValueError("unknown {} {!r}".format(name, value))
+
+
+class Importer:
+    """Import rows, keeping the name -> pk maps of the related objects between imports."""
+
+    def __init__(self, batch_size=BATCH_SIZE, user=None):
+        self.batch_size = batch_size
+        self.user = user
+        self.events = dict(Event.objects.values_list('name', 'pk'))
+        self.sponsors = dict(Sponsor.objects.values_list('name', 'pk'))
+        self.categories = {
+            (event_id, name): (pk, amount)
+            for pk, event_id, name, amount in Category.objects.values_list(
+                'pk', 'event_id', 'name', 'amount')}
+
+    def _import_names(self, model, names_map, rows):
+        created = unchanged = 0
+        failed = {}
+        for batch in _batches(rows, self.batch_size):
+            new = {}
+            for line_number, row in _readable(batch, failed):
+                try:
+                    name = _get(row, 'name')
+                except ValueError as err:
+                    failed[line_number] = str(err)
+                    continue
+                if name in names_map or name in new:
+                    unchanged += 1
+                else:
+                    new[name] = model(name=name)
+            with transaction.atomic():
+                model.objects.bulk_create(new.values())
+            names_map.update((name, obj.pk) for name, obj in new.items())
+            created += len(new)
+        return ImportResult(created, 0, unchanged, failed)
+
+    def import_events(self, rows):
+        return self._import_names(Event, self.events, rows)
+
+    def import_sponsors(self, rows):
+        return self._import_names(Sponsor, self.sponsors, rows)
+
+    def import_categories(self, rows):
+        amount_field = Category._meta.get_field('amount')
+        created = updated = unchanged = 0
+        failed = {}
+        for batch in _batches(rows, self.batch_size):
+            new = {}
+            changed = {}
+            for line_number, row in _readable(batch, failed):
+                try:
+                    event_id = _ref(self.events, row, 'event')
+                    key = (event_id, _get(row, 'name'))
+                    amount = amount_field.to_python(_get(row, 'amount'))
+                except (ValueError, ValidationError) as err:
+                    failed[line_number] = " ".join(getattr(err, 'messages', [str(err)]))
+                    continue
+                if key in new:
+                    new[key].amount = amount
+                elif key not in self.categories:
+                    new[key] = Category(event_id=event_id, name=key[1], amount=amount)
+                elif self.categories[key][1] != amount:
+                    changed[key] = Category(pk=self.categories[key][0], amount=amount)
+                else:
+                    unchanged += 1
+            with transaction.atomic():
+                Category.objects.bulk_create(new.values())
+                Category.objects.bulk_update(changed.values(), ['amount'])
+            for key, category in [*new.items(), *changed.items()]:
+                self.categories[key] = (category.pk, category.amount)
+            created += len(new)
+            updated += len(changed)
+        return ImportResult(created, updated, unchanged, failed)
+
+    def import_incomes(self, rows):
+        """Import incomes, each one created directly in its row's state (the first by default).
+
+        Income is a multi-table model, which can't be bulk created, so the incomes of each
+        batch are saved one by one, in one transaction with their history.
+        """
+        table = Income._fsm_table
+        states = {step.next_state for step in table.steps}
+        # the rows are created (from no state) directly, so that's the step in their history
+        creation = next(step for step in table.steps if step.current_state is None)
+
+        created = unchanged = 0
+        failed = {}
+        for batch in _batches(rows, self.batch_size):
+            new = {}
+            for line_number, row in _readable(batch, failed):
+                try:
+                    event_id = _ref(self.events, row, 'event')
+                    sponsor_id = _ref(self.sponsors, row, 'sponsor')
+                    category = _get(row, 'category')
+                    if (event_id, category) not in self.categories:
+                        raise ValueError("unknown category {!r} for the event".format(category))
+                    category_id = self.categories[(event_id, category)][0]
+                    state = str(row.get('state') or creation.next_state).strip()
+                    if state not in states:
+                        raise ValueError("invalid state {!r}".format(state))
+                except ValueError as err:
+                    failed[line_number] = str(err)
+                    continue
+                new.setdefault((event_id, sponsor_id, category_id), (line_number, state))
+
+            existing = set(Income.objects.filter(
+                sponsor_id__in={sponsor_id for _, sponsor_id, _ in new},
+                category_id__in={category_id for _, _, category_id in new},
+            ).values_list('event_id', 'sponsor_id', 'category_id'))
+            unchanged += len(batch) - len(new) - sum(
+                1 for line_number, _ in batch if line_number in failed)
+            with transaction.atomic(), recorded_saves():
+                moves = []
+                for key, (line_number, state) in new.items():
+                    if key in existing:
+                        unchanged += 1
+                        continue
+                    event_id, sponsor_id, category_id = key
+                    income = Income.objects.create(
+                        state=state, event_id=event_id, sponsor_id=sponsor_id,
+                        category_id=category_id)
+                    moves.append((income.pk, None, state, creation.index))
+                if moves:
+                    record_transitions(Income, moves, self.user, notify=False)
+            created += len(moves)
+        return ImportResult(created, 0, unchanged, failed)
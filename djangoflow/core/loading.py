@@ -0,0 +1,39 @@
+"""Query plans to load a whole flow instance with a fixed number of queries.
+
+The plan of each model is derived once from its fields and its `fsm`: forward relations
+are joined, many to many relations (and the reverse ones worked in some step) are
+prefetched, and the model's `fsm_totals` are computed by the database.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+LoadPlan = namedtuple('LoadPlan', "select_related prefetch_related totals")
+
+
+@lru_cache(maxsize=None)
+def get_load_plan(model):
+    """Return the LoadPlan to show the instances of the FSM model."""
+    select_related = []
+    for field in model._meta.concrete_fields:
+        if field.is_relation and not field.remote_field.parent_link:
+            select_related.append(field.name)
+
+    prefetch_related = [field.name for field in model._meta.many_to_many]
+    worked = {name for step in model._fsm_table.steps for name in step.fields}
+    for relation in model._meta.related_objects:
+        if relation.get_accessor_name() in worked:
+            prefetch_related.append(relation.get_accessor_name())
+
+    return LoadPlan(
+        select_related=tuple(select_related),
+        prefetch_related=tuple(prefetch_related),
+        totals=tuple(getattr(model, 'fsm_totals', {}).items()),
+    )
+
+
+def detail_queryset(model):
+    """Return a queryset of the model that loads everything the flow pages show."""
+    plan = get_load_plan(model)
+    return model.objects.select_related(*plan.select_related).prefetch_related(
+        *plan.prefetch_related).annotate(**dict(plan.totals))
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core import archiving
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the incomes finished long ago, with their payments and history, to the archive "
+        "tables. It can be interrupted and run again at any time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, metavar='DAYS',
+            help="Archive the flows finished more than these days ago "
+                 "(by default, FLOW_ARCHIVE_AFTER_DAYS).")
+        parser.add_argument(
+            '--batch-size', type=int, default=archiving.BATCH_SIZE,
+            help="Flows moved per transaction.")
+        parser.add_argument(
+            '--max-batches', type=int, help="Stop after these batches (to spread the work).")
+        parser.add_argument(
+            '--dry-run', action='store_true', help="Only report how many would be archived.")
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options['older_than'] is not None:
+            older_than = timedelta(days=options['older_than'])
+        if options['dry_run']:
+            count = archiving.get_archivable(older_than).count()
+            self.stdout.write("{} incomes would be archived.".format(count))
+            return
+        total = archiving.archive(
+            older_than, batch_size=options['batch_size'], max_batches=options['max_batches'])
+        self.stdout.write("Archived {} incomes.".format(total))
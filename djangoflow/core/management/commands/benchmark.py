@@ -0,0 +1,194 @@
+import json
+import math
+import random
+import statistics
+import time
+import timeit
+import tracemalloc
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import ADMIN, ORGZER, Category, Event, Income, Profile, Sponsor
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the flow views and the FSM engine on a freshly seeded SQLite database, "
+        "optionally comparing with a previous run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=10)
+        parser.add_argument('--sponsors', type=int, default=200)
+        parser.add_argument('--categories', type=int, default=5, help="Per event.")
+        parser.add_argument('--incomes', type=int, default=2000)
+        parser.add_argument(
+            '--repeat', type=int, default=20, help="Measured requests per round.")
+        parser.add_argument(
+            '--rounds', type=int, default=5,
+            help="Rounds of each benchmark; the best round is reported, to leave out noise.")
+        parser.add_argument(
+            '--database-file',
+            help="Seed this SQLite file instead of an in-memory database (it's overwritten).")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--compare', help="A previous results JSON file to compare with.")
+        parser.add_argument(
+            '--threshold', type=float, default=1.25,
+            help="With --compare, fail if a time grows more than this factor, or any query count.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if options['database_file']:
+            test_settings['NAME'] = options['database_file']
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.seed(options)
+            results = self.run_benchmarks(options['repeat'], options['rounds'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'time': timezone.now().isoformat(),
+                'incomes': options['incomes'],
+                'events': options['events'],
+                'sponsors': options['sponsors'],
+                'categories': options['categories'],
+                'repeat': options['repeat'],
+                'rounds': options['rounds'],
+            },
+            'results': results,
+        }
+        for name, result in results.items():
+            self.stdout.write("{:<24} {}".format(name, ", ".join(
+                "{}={}".format(key, value) for key, value in result.items())))
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(report, fh, indent=2)
+        if options['compare']:
+            self.compare(results, options['compare'], options['threshold'])
+
+    def seed(self, options):
+        rnd = random.Random(42)
+        with transaction.atomic():
+            events = Event.objects.bulk_create(
+                Event(name="Event {}".format(i)) for i in range(options['events']))
+            sponsors = Sponsor.objects.bulk_create(
+                Sponsor(name="Sponsor {}".format(i)) for i in range(options['sponsors']))
+            categories = Category.objects.bulk_create(
+                Category(name="Category {}".format(i), amount=1000 * (i + 1), event=event)
+                for event in events for i in range(options['categories']))
+            states = [state for state, _ in Income.STATE_CHOICES]
+            # Income is a multi-table model, so it can't be bulk created
+            for i in range(options['incomes']):
+                category = rnd.choice(categories)
+                Income.objects.create(
+                    state=states[i % len(states)], event_id=category.event_id,
+                    sponsor=rnd.choice(sponsors), category=category)
+            for role in (ORGZER, ADMIN):
+                user = User.objects.create_user(role)
+                Profile.objects.create(user=user, security_clearance=role)
+        call_command('rebuild_workitems', stdout=StringIO())
+
+    def measure(self, repeat, rounds, function):
+        """Time the request `repeat` times per round, then once more tracing its memory.
+
+        The median is the one of the best round (the others had more noise from the machine).
+        """
+        times = []
+        medians = []
+        queries = 0
+        for _ in range(rounds):
+            round_times = []
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = function()
+                    round_times.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    raise CommandError("Got a {} response".format(response.status_code))
+                queries = max(queries, len(captured))
+            medians.append(statistics.median(round_times))
+            times.extend(round_times)
+        # tracing slows everything down, so it's kept out of the timings
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times.sort()
+        return {
+            'median_ms': round(min(medians) * 1000, 3),
+            'p90_ms': round(times[max(math.ceil(len(times) * 0.9) - 1, 0)] * 1000, 3),
+            'queries': queries,
+            'peak_kb': round(peak / 1024, 1),
+        }
+
+    def micro(self, function, rounds, number=100000):
+        best = min(timeit.repeat(function, number=number, repeat=rounds))
+        return {'per_call_ns': round(best / number * 1e9, 1)}
+
+    def run_benchmarks(self, repeat, rounds):
+        clients = {}
+        for role in (ORGZER, ADMIN):
+            clients[role] = Client()
+            clients[role].force_login(User.objects.get(username=role))
+
+        home = reverse('home')
+        results = {}
+        for role, client in clients.items():
+            def cold_home(client=client):
+                cache.clear()
+                return client.get(home)
+            results['home_cold_' + role] = self.measure(repeat, rounds, cold_home)
+            results['home_warm_' + role] = self.measure(
+                repeat, rounds, lambda client=client: client.get(home))
+
+        organizer = clients[ORGZER]
+        create_url = reverse('create_flow', kwargs={'fsmmodel': Income})
+        results['create_get'] = self.measure(repeat, rounds, lambda: organizer.get(create_url))
+        waiting = list(Income.objects.filter(state=Income.S_HAVE_INVOICE).values_list(
+            'pk', flat=True)[:repeat * rounds + 1])
+        if len(waiting) <= repeat * rounds:
+            raise CommandError("Not enough incomes to benchmark, use more --incomes")
+        update_url = reverse('update_flow', kwargs={'fsmmodel': Income, 'pk': waiting[0]})
+        results['update_get'] = self.measure(repeat, rounds, lambda: organizer.get(update_url))
+        # each post moves a different income to the next state
+        post_urls = iter(
+            reverse('post_flow', kwargs={'fsmmodel': Income, 'step_index': 2, 'pk': pk})
+            for pk in waiting)
+        results['step_post'] = self.measure(
+            repeat, rounds, lambda: organizer.post(next(post_urls), {'ready_to_payment': 'on'}))
+
+        results['get_steps'] = self.micro(
+            lambda: Income.get_steps(Income.S_READY_TO_PAYMENT, ADMIN), rounds)
+        results['get_create_roles'] = self.micro(Income.get_create_roles, rounds)
+        return results
+
+    def compare(self, results, path, threshold):
+        with open(path) as fh:
+            baseline = json.load(fh)['results']
+        regressions = []
+        for name, result in results.items():
+            old = baseline.get(name)
+            if old is None:
+                continue
+            key = 'median_ms' if 'median_ms' in result else 'per_call_ns'
+            ratio = result[key] / old[key] if old[key] else 1
+            self.stdout.write("{:<24} {:.2f}x".format(name, ratio))
+            if ratio > threshold:
+                regressions.append("{} {:.2f}x slower".format(name, ratio))
+            # the query counts are deterministic, any growth is a regression
+            if result.get('queries', 0) > old.get('queries', 0):
+                regressions.append("{} does {} queries instead of {}".format(
+                    name, result['queries'], old['queries']))
+        if regressions:
+            raise CommandError("Regressions: " + "; ".join(regressions))
@@ -0,0 +1,64 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.forms import models as model_forms
+
+from core import forms, registry
+
+
+def _uncached_create(model, steps):
+    for step in steps:
+        model_forms.modelform_factory(model, fields=forms.get_form_fields(model, step))()
+
+
+def _cached_create(model, steps):
+    for step in steps:
+        forms.get_step_form_class(model, step.index)()
+
+
+def _uncached_update(model, instance, steps):
+    form_class = model_forms.modelform_factory(model, fields='__all__')
+    form = form_class(instance=instance)
+    for field in form.fields.values():
+        field.widget.attrs['disabled'] = True
+    _uncached_create(model, steps)
+
+
+def _cached_update(model, instance, steps):
+    forms.get_instance_form_class(model)(instance=instance)
+    _cached_create(model, steps)
+
+
+class Command(BaseCommand):
+    help = "Measure the form building cost per request of the create and update flow views."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests', type=int, default=1000, help="Simulated requests for each case.")
+
+    def handle(self, *args, **options):
+        number = options['requests']
+        for model in registry.get_models():
+            table = model._fsm_table
+            instance = model()
+            for role in sorted(table.create_roles):
+                steps = model.get_steps(None, role)
+                self._report(
+                    "{} create ({})".format(model.__name__, role), number,
+                    lambda: _uncached_create(model, steps),
+                    lambda: _cached_create(model, steps))
+            for (state, role), steps in sorted(
+                    table.by_state_role.items(), key=lambda item: item[1][0].index):
+                if state is None:
+                    continue
+                self._report(
+                    "{} update ({}, {})".format(model.__name__, state, role), number,
+                    lambda: _uncached_update(model, instance, steps),
+                    lambda: _cached_update(model, instance, steps))
+
+    def _report(self, title, number, uncached, cached):
+        uncached_time = timeit.timeit(uncached, number=number) / number
+        cached_time = timeit.timeit(cached, number=number) / number
+        self.stdout.write(
+            "{}: {:.1f}us -> {:.1f}us per request ({:.1f}x)".format(
+                title, uncached_time * 1e6, cached_time * 1e6, uncached_time / cached_time))
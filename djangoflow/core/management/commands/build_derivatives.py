@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core import storage
+from core.models import ExtraDocument, Invoice
+
+
+class Command(BaseCommand):
+    help = "Make the missing thumbnails and previews of all the stored images."
+
+    def handle(self, *args, **options):
+        names = set()
+        for model in (Invoice, ExtraDocument):
+            names.update(
+                model.objects.exclude(image='').values_list('image', flat=True).iterator())
+        for name in sorted(names):
+            storage.make_derivatives(name)
+        self.stdout.write("Checked the derivatives of {} images.".format(len(names)))
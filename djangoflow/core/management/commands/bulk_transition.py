@@ -0,0 +1,58 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core import registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Move many instances of a FSM model through a step at once (by default, all the "
+        "instances in the step's current state).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="The FSM model name, e.g. Income.")
+        parser.add_argument('step_index', type=int, help="The index of the step in the fsm.")
+        parser.add_argument(
+            '--set', action='append', default=[], metavar='FIELD=VALUE',
+            help="A value for one of the step's fields (can be repeated).")
+        parser.add_argument(
+            '--pk', action='append', type=int, default=[],
+            help="Only move this instance (can be repeated).")
+        parser.add_argument(
+            '--user', required=True, help="Username recorded as the author of the changes.")
+        parser.add_argument('--batch-size', type=int, help="Instances moved per transaction.")
+
+    def handle(self, *args, **options):
+        try:
+            model = registry.get_model(options['model'])
+        except LookupError as err:
+            raise CommandError(err)
+        try:
+            step = model.get_step_by_index(options['step_index'])
+        except IndexError:
+            raise CommandError("{} has no step {}".format(model.__name__, options['step_index']))
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError("No user {!r}".format(options['user']))
+
+        values = {}
+        for assignment in options['set']:
+            name, sep, value = assignment.partition('=')
+            if not sep:
+                raise CommandError("Values must be FIELD=VALUE, got {!r}".format(assignment))
+            values[name] = value
+
+        queryset = model.objects.filter(state=step.current_state)
+        if options['pk']:
+            queryset = model.objects.filter(pk__in=options['pk'])
+        try:
+            result = model.bulk_transition(
+                queryset, step.index, values, user, batch_size=options['batch_size'])
+        except ValueError as err:
+            raise CommandError(err)
+
+        for pk, reason in sorted(result.failed.items()):
+            self.stderr.write("{} {}: {}".format(model.__name__, pk, reason))
+        self.stdout.write("Moved {} to {!r}, {} failed.".format(
+            len(result.done), step.next_state, len(result.failed)))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import exporting
+
+
+class Command(BaseCommand):
+    help = "Export the flows of a FSM model, or the history of the flows, as CSV or JSON lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=exporting.KINDS)
+        parser.add_argument('--model', help="The FSM model name, e.g. Income.")
+        parser.add_argument('--state', help="Only the flows in (or transitions to) this state.")
+        parser.add_argument(
+            '--since', metavar='YYYY-MM-DD',
+            help="Only the flows created (or transitions done) since this day.")
+        parser.add_argument(
+            '--until', metavar='YYYY-MM-DD',
+            help="Only the flows created (or transitions done) until this day, included.")
+        parser.add_argument('--format', choices=exporting.FORMATS, default='csv')
+        parser.add_argument('--output', help="The file to write, by default the standard output.")
+
+    def handle(self, *args, **options):
+        try:
+            headers, rows = exporting.get_rows(
+                options['kind'], options['model'], options['state'], options['since'],
+                options['until'])
+        except ValueError as err:
+            raise CommandError(err)
+
+        lines = exporting.encode(headers, rows, options['format'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as fh:
+                fh.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,30 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import fsm, registry
+
+
+class Command(BaseCommand):
+    help = "Write the Graphviz (DOT) graph of the FSM models' flows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help="FSM model names, by default all.")
+        parser.add_argument(
+            '--output-dir',
+            help="Write a <model>.dot file for each model here, instead of the standard output.")
+
+    def handle(self, *args, **options):
+        try:
+            models = [registry.get_model(name) for name in options['models']]
+        except LookupError as err:
+            raise CommandError(err)
+        for model in models or registry.get_models():
+            dot = fsm.to_dot(model.__name__, model._fsm_table)
+            if options['output_dir']:
+                path = os.path.join(options['output_dir'], model.__name__ + '.dot')
+                with open(path, 'w') as fh:
+                    fh.write(dot)
+                self.stdout.write("Wrote {}".format(path))
+            else:
+                self.stdout.write(dot, ending='')
@@ -0,0 +1,51 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core import importing
+
+KINDS = ('events', 'sponsors', 'categories', 'incomes')
+
+
+class Command(BaseCommand):
+    help = (
+        "Import events, sponsors, categories or incomes from a CSV or JSON lines file; "
+        "rows already in the database are skipped (or updated), so it can be run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=KINDS)
+        parser.add_argument('path', help="The file to import.")
+        parser.add_argument(
+            '--format', choices=importing.FORMATS,
+            help="The file format, by default guessed from its extension.")
+        parser.add_argument(
+            '--batch-size', type=int, default=importing.BATCH_SIZE,
+            help="Rows written per transaction.")
+        parser.add_argument(
+            '--user', help="Username recorded as the author of the imported incomes.")
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.')
+        if format not in importing.FORMATS:
+            raise CommandError("Unknown format {!r}, use --format".format(format))
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("No user {!r}".format(options['user']))
+
+        importer = importing.Importer(batch_size=options['batch_size'], user=user)
+        with open(options['path'], newline='') as fh:
+            rows = importing.read_rows(fh, format)
+            try:
+                result = getattr(importer, 'import_' + options['kind'])(rows)
+            except ValueError as err:
+                raise CommandError(err)
+
+        for line_number, reason in sorted(result.failed.items()):
+            self.stderr.write("Line {}: {}".format(line_number, reason))
+        self.stdout.write("{} {}: {} created, {} updated, {} unchanged, {} failed.".format(
+            "Imported" if not result.failed else "Partially imported", options['kind'],
+            result.created, result.updated, result.unchanged, len(result.failed)))
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+
+from core import forms, transitions
+from core.models import ORGZER, Category, Event, Income, Profile, Sponsor, WorkItem
+
+MODES = ('default', 'production')
+
+
+def _worker(pks):
+    """Create a flow, read the home page items and do a step, for each pk; return counts."""
+    done = errors = 0
+    try:
+        user = User.objects.get(username=ORGZER)
+        category = Category.objects.get()
+        sponsor = Sponsor.objects.get()
+        create_form_class = forms.get_step_form_class(Income, 0)
+        step_form_class = forms.get_step_form_class(Income, 2)
+        for pk in pks:
+            try:
+                form = create_form_class({
+                    'event': category.event_id, 'sponsor': sponsor.pk, 'category': category.pk})
+                form.is_valid()
+                transitions.apply_step(Income.get_step_by_index(0), form, user)
+                list(WorkItem.objects.filter(role=ORGZER).order_by('since', 'pk')[:50])
+                form = step_form_class(
+                    {'ready_to_payment': 'on'}, instance=Income.objects.get(pk=pk))
+                form.is_valid()
+                transitions.apply_step(Income.get_step_by_index(2), form, user)
+                done += 1
+            except OperationalError:
+                errors += 1
+    finally:
+        connections.close_all()
+    return done, errors
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the flow writes from several processes on a scratch SQLite database, "
+        "with the default settings and with the SQLITE_PRODUCTION ones.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument(
+            '--flows', type=int, default=100,
+            help="Flows created and moved by each process.")
+        parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            for mode in options['modes']:
+                done, errors, elapsed = self.run_mode(
+                    mode, os.path.join(directory, mode + '.sqlite3'), options['processes'],
+                    options['flows'])
+                self.stdout.write(
+                    "{:<10} {:>8.1f} flows/s  {} done, {} failed with locks, {:.2f}s".format(
+                        mode, done / elapsed, done, errors, elapsed))
+
+    def run_mode(self, mode, path, processes, flows):
+        settings_dict = connection.settings_dict
+        original = {key: settings_dict.get(key) for key in [*settings.SQLITE_PRODUCTION, 'TEST']}
+        settings_dict['TEST'] = dict(settings_dict.get('TEST') or {}, NAME=path)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            if mode == 'production':
+                connection.close()
+                settings_dict.update(settings.SQLITE_PRODUCTION)
+            pks = self.seed(processes * flows)
+            # the children must not share the parent's database connections
+            connections.close_all()
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(
+                    _worker, [pks[i::processes] for i in range(processes)]))
+            elapsed = time.perf_counter() - start
+        finally:
+            connection.close()
+            # this drops the scratch database, and points the connection to the real one
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            settings_dict.update(original)
+        return sum(done for done, _ in results), sum(errors for _, errors in results), elapsed
+
+    def seed(self, count):
+        with transaction.atomic():
+            event = Event.objects.create(name="Event")
+            sponsor = Sponsor.objects.create(name="Sponsor")
+            category = Category.objects.create(name="Gold", amount=1000, event=event)
+            user = User.objects.create_user(ORGZER)
+            Profile.objects.create(user=user, security_clearance=ORGZER)
+            # Income is a multi-table model, so it can't be bulk created
+            return [
+                Income.objects.create(
+                    state=Income.S_HAVE_INVOICE, event=event, sponsor=sponsor,
+                    category=category).pk
+                for _ in range(count)]
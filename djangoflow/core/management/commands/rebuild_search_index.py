@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from core import registry, search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search documents of all the flows (or of the given FSM models)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help="FSM model names; all by default.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The search needs SQLite (with FTS5).")
+        models = [model for model in registry.get_models() if search.is_enabled(model)]
+        if options['models']:
+            by_name = {model.__name__: model for model in models}
+            unknown = set(options['models']) - set(by_name)
+            if unknown:
+                raise CommandError("Not searchable FSM models: {}".format(
+                    ", ".join(sorted(unknown))))
+            models = [by_name[name] for name in options['models']]
+        for model in models:
+            with transaction.atomic():
+                total = search.rebuild(model)
+            self.stdout.write("Indexed {} {} flows.".format(total, model.__name__))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from core import caching, registry
+from core.models import Transition, WorkItem
+from core.transitions import build_work_items
+
+
+class Command(BaseCommand):
+    help = "Rebuild the WorkItem table from the current state of all the FSM models."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help="WorkItems inserted per query.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        now = timezone.now()
+        with transaction.atomic():
+            WorkItem.objects.all().delete()
+            total = 0
+            for model in registry.get_models():
+                open_states = [
+                    state for state in model._fsm_table.roles_by_state if state is not None]
+                # the items are waiting since the last transition of their flow
+                last_change = Transition.objects.filter(
+                    model=model.__name__, object_pk=OuterRef('pk')).order_by('-time')
+                rows = model.objects.filter(state__in=open_states).annotate(
+                    since=Subquery(last_change.values('time')[:1])
+                ).values_list('pk', 'state', 'since')
+                items = []
+                for pk, state, since in rows.iterator(chunk_size=batch_size):
+                    items.extend(build_work_items(model, pk, state, since or now))
+                    if len(items) >= batch_size:
+                        WorkItem.objects.bulk_create(items)
+                        total += len(items)
+                        items = []
+                WorkItem.objects.bulk_create(items)
+                total += len(items)
+        caching.bump_open_version()
+        self.stdout.write("Created {} work items.".format(total))
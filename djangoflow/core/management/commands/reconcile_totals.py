@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from core.models import Income, PaymentReceived
+
+
+def _actual_total():
+    totals = PaymentReceived.objects.filter(income=OuterRef('pk')).order_by().values(
+        'income').annotate(total=Sum('amount')).values('total')
+    return Coalesce(Subquery(totals), Value(0), output_field=DecimalField())
+
+
+class Command(BaseCommand):
+    help = "Recompute Income.total_received from the payments, fixing the ones that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help="Incomes fixed per transaction.")
+        parser.add_argument(
+            '--dry-run', action='store_true', help="Only report the drifted incomes.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        drifted = list(
+            Income.objects.annotate(actual=_actual_total())
+            .exclude(total_received=F('actual')).order_by('pk').values_list('pk', flat=True))
+        for pk in drifted:
+            self.stdout.write("Income {} drifted".format(pk), self.style.WARNING)
+        if not options['dry_run']:
+            for start in range(0, len(drifted), batch_size):
+                with transaction.atomic():
+                    Income.objects.filter(pk__in=drifted[start:start + batch_size]).update(
+                        total_received=_actual_total())
+        self.stdout.write("{} incomes {}.".format(
+            len(drifted), "drifted" if options['dry_run'] else "fixed"))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import notifications
+
+
+class Command(BaseCommand):
+    help = "Send the pending transition notifications, as digests, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100, help="Transitions per digest.")
+        parser.add_argument(
+            '--workers', type=int, default=0,
+            help="Send the batches in parallel with this many workers (default: inline).")
+        parser.add_argument(
+            '--processes', action='store_true', help="Use processes instead of threads.")
+        parser.add_argument(
+            '--loop', type=float, metavar='SECONDS',
+            help="Keep draining the outbox, waiting this long between runs.")
+
+    def handle(self, *args, **options):
+        while True:
+            sent = notifications.drain(
+                options['batch_size'], options['workers'], options['processes'])
+            self.stdout.write("Sent {} mails.".format(sent))
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,157 @@
+"""Per request metrics of the flow views, opt-in and sampled.
+
+Add FlowMetricsMiddleware and set FLOW_METRICS_SAMPLE_RATE to the fraction of the requests
+to measure (0, the default, turns the middleware off). Each measured request is logged as
+a JSON object to the 'core.metrics' logger, and summed in this process' totals, that
+MetricsView serves in the Prometheus text format (to the admins, or with the
+FLOW_METRICS_TOKEN).
+"""
+
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import connection
+from django.http import HttpResponse
+from django.views.generic.edit import View
+
+from core import caching
+from core.models import ADMIN
+
+logger = logging.getLogger(__name__)
+
+# the totals kept for each view, model and step: (record key, metric name, help)
+METRICS = (
+    ('requests', 'flow_requests_total', "Requests measured."),
+    ('seconds', 'flow_request_seconds_total', "Time spent in the requests."),
+    ('db_queries', 'flow_db_queries_total', "Database queries done."),
+    ('db_seconds', 'flow_db_seconds_total', "Time spent in database queries."),
+    ('template_seconds', 'flow_template_seconds_total', "Time spent rendering templates."),
+    ('cache_hits', 'flow_cache_hits_total', "Home page fragments got from the cache."),
+    ('cache_misses', 'flow_cache_misses_total', "Home page fragments built."),
+)
+
+_lock = threading.Lock()
+_totals = defaultdict(lambda: dict.fromkeys([key for key, _, _ in METRICS], 0))
+
+
+def _query_timer(record):
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            record['db_queries'] += 1
+            record['db_seconds'] += time.perf_counter() - start
+    return wrapper
+
+
+def add(record):
+    """Sum a measured request to the totals."""
+    step = '' if record['step'] is None else str(record['step'])
+    labels = (record['view'] or '', record['model'] or '', step)
+    with _lock:
+        totals = _totals[labels]
+        totals['requests'] += 1
+        for key in totals:
+            if key != 'requests':
+                totals[key] += record[key]
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def render_prometheus():
+    """Return the totals in the Prometheus text exposition format."""
+    with _lock:
+        totals = {labels: dict(values) for labels, values in _totals.items()}
+    lines = []
+    for key, name, help_text in METRICS:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for (view, model, step), values in sorted(totals.items()):
+            lines.append('{}{{view="{}",model="{}",step="{}"}} {}'.format(
+                name, view, model, step, values[key]))
+    return '\n'.join(lines) + '\n'
+
+
+class FlowMetricsMiddleware:
+    """Measure the view, FSM model, step, time, queries, rendering and cache use of requests."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'FLOW_METRICS_SAMPLE_RATE', 0)
+        if not self.sample_rate:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        record = request.flow_metrics = {
+            'view': None, 'model': None, 'step': None,
+            'db_queries': 0, 'db_seconds': 0.0, 'template_seconds': 0.0,
+        }
+        # the fragment stats are per process, so concurrent requests may mix a little
+        cache_before = caching.get_stats()
+        start = time.perf_counter()
+        with connection.execute_wrapper(_query_timer(record)):
+            response = self.get_response(request)
+        record['seconds'] = time.perf_counter() - start
+        cache_after = caching.get_stats()
+        for kind in ('hits', 'misses'):
+            record['cache_' + kind] = sum(
+                cache_after[key] - cache_before[key] for key in cache_after
+                if key.endswith(kind))
+        record['status'] = response.status_code
+
+        add(record)
+        logger.info(json.dumps(record))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        record = getattr(request, 'flow_metrics', None)
+        if record is None:
+            return None
+        record['view'] = request.resolver_match.view_name
+        model = view_kwargs.get('fsmmodel')
+        record['model'] = model.__name__ if model is not None else None
+        record['step'] = view_kwargs.get('step_index')
+        return None
+
+    def process_template_response(self, request, response):
+        record = getattr(request, 'flow_metrics', None)
+        if record is None:
+            return response
+        start = time.perf_counter()
+
+        def rendered(response):
+            record['template_seconds'] += time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def _has_token(request):
+    token = getattr(settings, 'FLOW_METRICS_TOKEN', None)
+    if not token:
+        return False
+    given = request.META.get('HTTP_AUTHORIZATION', '')
+    return hmac.compare_digest(given.encode(), 'Bearer {}'.format(token).encode())
+
+
+class MetricsView(View):
+    """The metrics totals, for the admins and for Prometheus (with FLOW_METRICS_TOKEN)."""
+
+    def get(self, request):
+        if not _has_token(request) and ADMIN not in request.roles:
+            raise PermissionDenied
+        return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4')
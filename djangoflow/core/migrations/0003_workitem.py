@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20190303_0438'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(max_length=256)),
+                ('model', models.CharField(max_length=256)),
+                ('object_pk', models.IntegerField()),
+                ('state', models.CharField(max_length=256)),
+                ('since', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['role', 'since'], name='core_workit_role_2d6cfa_idx'), models.Index(fields=['model', 'object_pk'], name='core_workit_model_6a65bc_idx')],
+            },
+        ),
+    ]
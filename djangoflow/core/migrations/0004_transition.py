@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_workitem'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=256)),
+                ('object_pk', models.IntegerField()),
+                ('from_state', models.CharField(max_length=256, null=True)),
+                ('to_state', models.CharField(max_length=256)),
+                ('step_index', models.IntegerField()),
+                ('time', models.DateTimeField()),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'object_pk', 'time'], name='core_transi_model_97e413_idx'), models.Index(fields=['user', 'time'], name='core_transi_user_id_5828f3_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_pendingnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='income',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
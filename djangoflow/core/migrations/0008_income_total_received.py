@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:32
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+
+
+def compute_totals(apps, schema_editor):
+    Income = apps.get_model('core', 'Income')
+    PaymentReceived = apps.get_model('core', 'PaymentReceived')
+    totals = PaymentReceived.objects.filter(income=OuterRef('pk')).order_by().values(
+        'income').annotate(total=Sum('amount')).values('total')
+    Income.objects.filter(payments_received__isnull=False).update(
+        total_received=Subquery(totals))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_income_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='income',
+            name='total_received',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=20),
+        ),
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
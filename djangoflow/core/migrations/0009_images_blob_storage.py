@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:41
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_income_total_received'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='extradocument',
+            name='image',
+            field=models.ImageField(storage=core.storage.ContentAddressedStorage(), upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='image',
+            field=models.ImageField(storage=core.storage.ContentAddressedStorage(), upload_to=''),
+        ),
+    ]
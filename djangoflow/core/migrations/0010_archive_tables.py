@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_images_blob_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IncomeArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('init', 'Init'), ('have-invoice', 'Have an invoice'), ('ready-to-payment', 'Ready to payment'), ('payment-done', 'The payment is done, all finished'), ('partial-payment', 'Partial payment received, need more')], max_length=256)),
+                ('version', models.PositiveIntegerField()),
+                ('ready_to_payment', models.BooleanField(null=True)),
+                ('payment_done', models.BooleanField(null=True)),
+                ('total_received', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('archived', models.DateTimeField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.category')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.event')),
+                ('extra_docs', models.ManyToManyField(related_name='+', to='core.extradocument')),
+                ('invoice', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.invoice')),
+                ('sponsor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.sponsor')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('income', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payments_received', to='core.incomearchive')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='TransitionArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('model', models.CharField(max_length=256)),
+                ('object_pk', models.IntegerField()),
+                ('from_state', models.CharField(max_length=256, null=True)),
+                ('to_state', models.CharField(max_length=256)),
+                ('step_index', models.IntegerField()),
+                ('time', models.DateTimeField()),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'object_pk', 'time'], name='core_transi_model_c186ae_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def create_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS core_search_income USING fts5(body, "
+            "prefix='2 3', tokenize='unicode61 remove_diacritics 2')")
+
+
+def drop_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_search_income')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_archive_tables'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_table, drop_table),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_income_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='incomearchive',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.category'),
+        ),
+        migrations.AlterField(
+            model_name='incomearchive',
+            name='event',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.event'),
+        ),
+        migrations.AlterField(
+            model_name='incomearchive',
+            name='invoice',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.invoice'),
+        ),
+        migrations.AlterField(
+            model_name='incomearchive',
+            name='sponsor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.sponsor'),
+        ),
+        migrations.AlterField(
+            model_name='paymentarchive',
+            name='income',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='payments_received', to='core.incomearchive'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_archive_protect'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transition',
+            name='step_index',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='transitionarchive',
+            name='step_index',
+            field=models.IntegerField(null=True),
+        ),
+    ]
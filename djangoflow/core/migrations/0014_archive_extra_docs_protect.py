@@ -0,0 +1,46 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Protect the links to the extra documents of the archived incomes.
+
+    The table is the one Django created for the many to many field, only its model is explicit
+    now (so its foreign keys can be PROTECT); nothing changes in the database.
+    """
+
+    dependencies = [
+        ('core', '0013_transition_step_index_null'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='IncomeArchiveExtraDoc',
+                    fields=[
+                        ('id', models.AutoField(
+                            auto_created=True, primary_key=True, serialize=False,
+                            verbose_name='ID')),
+                        ('extradocument', models.ForeignKey(
+                            on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                            to='core.extradocument')),
+                        ('incomearchive', models.ForeignKey(
+                            on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                            to='core.incomearchive')),
+                    ],
+                    options={
+                        'db_table': 'core_incomearchive_extra_docs',
+                        'unique_together': {('incomearchive', 'extradocument')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='incomearchive',
+                    name='extra_docs',
+                    field=models.ManyToManyField(
+                        related_name='+', through='core.IncomeArchiveExtraDoc',
+                        to='core.extradocument'),
+                ),
+            ],
+        ),
+    ]
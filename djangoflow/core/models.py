@@ -1,26 +1,35 @@
-from collections import namedtuple
-
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import (
     BooleanField,
     CASCADE,
     CharField,
     DateTimeField,
     DecimalField,
+    ExpressionWrapper,
+    F,
     ForeignKey,
     ImageField,
+    Index,
+    IntegerField,
     ManyToManyField,
     Model,
     OneToOneField,
+    PositiveIntegerField,
+    PROTECT,
+    QuerySet,
+    SET_NULL,
     TextField,
+    Value,
 )
 
+from core.fsm import Step, compile_fsm  # NOQA: Step is part of this module's API
+from core.storage import blob_storage
+
 
 ORGZER = 'organizer'
 ADMIN = 'admin'
 
-Step = namedtuple('Step', "index current_state role next_state fields")
-
 
 class Profile(Model):
     user = OneToOneField(User, on_delete=CASCADE)
@@ -54,15 +63,65 @@ class Category(Model):
 
 class ExtraDocument(Model):
     """Extra documents for the Income."""
-    image = ImageField()
+    image = ImageField(storage=blob_storage)
     comment = TextField()
 
 
 class PaymentReceived(Model):
+    """A payment for an Income; saving or deleting it keeps `Income.total_received` updated.
+
+    Bulk operations (QuerySet.update/delete, bulk_create) skip that, run
+    `manage.py reconcile_totals` after them.
+    """
     timestamp = DateTimeField()
     amount = DecimalField(max_digits=20, decimal_places=2)
     income = ForeignKey('Income', related_name="payments_received", on_delete=CASCADE)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # what is already counted in the income's total
+        instance._counted = (instance.__dict__.get('income_id'), instance.__dict__.get('amount'))
+        return instance
+
+    def _get_counted(self):
+        # (a new object may have the pk of a row that is already counted)
+        counted = getattr(self, '_counted', (None, None))
+        if self.pk is not None and None in counted:
+            counted = PaymentReceived.objects.filter(pk=self.pk).values_list(
+                'income_id', 'amount').first() or (None, None)
+        return counted
+
+    @staticmethod
+    def _add_to_total(income_id, amount):
+        Income.objects.filter(pk=income_id).update(total_received=F('total_received') + amount)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            old = self._get_counted()
+            super().save(*args, **kwargs)
+            # only the fields written change what is counted
+            income_id, amount = self.income_id, self.amount
+            if update_fields is not None:
+                if not {'income', 'income_id'} & set(update_fields):
+                    income_id = old[0]
+                if 'amount' not in update_fields:
+                    amount = old[1]
+            new = (income_id, amount)
+            if new != old:
+                if old[0] is not None:
+                    self._add_to_total(old[0], -old[1])
+                self._add_to_total(*new)
+        self._counted = new
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            income_id, amount = self._get_counted()
+            result = super().delete(*args, **kwargs)
+            self._add_to_total(income_id, -amount)
+        return result
+
 
 def Optional(field):
     field._fsm_optional = True
@@ -80,40 +139,84 @@ class Invoice(Model):
         ('C', 'C'),
     ))
     amount = DecimalField(max_digits=20, decimal_places=2)
-    image = ImageField()
+    image = ImageField(storage=blob_storage)
+
+
+class FSMQuerySet(QuerySet):
+
+    def actionable_by(self, *roles):
+        """Only the instances in a state where any of the given roles has something to do."""
+        states = set()
+        for role in roles:
+            states.update(self.model._fsm_table.states_by_role.get(role, ()))
+        return self.filter(state__in=sorted(states))
 
 
 class FSMModel(Model):
 
+    objects = FSMQuerySet.as_manager()
+
+    # the transition table compiled from `fsm` when the subclass is created
+    _fsm_table = None
+    fsm_final_state = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'fsm' in cls.__dict__:
+            cls._fsm_table = compile_fsm(cls.__name__, cls.fsm, cls.fsm_final_state)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # to know if a save outside the flow changes the state (see core.transitions)
+        instance._fsm_saved_state = instance.__dict__.get('state')
+        return instance
+
     @classmethod
     def get_step_by_index(cls, index):
-        step = cls.fsm[index]
-        return Step(
-            index=index, current_state=step[0], role=step[1], next_state=step[2], fields=step[3])
+        return cls._fsm_table.steps[index]
 
     @classmethod
     def get_steps(cls, state, role):
-        steps = []
-        for index, step in enumerate(cls.fsm):
-            if step[0] == state and step[1] == role:
-                steps.append(Step(
-                    index=index, current_state=step[0],
-                    role=step[1], next_state=step[2], fields=step[3]))
-        return steps
+        return cls._fsm_table.by_state_role.get((state, role), ())
+
+    @classmethod
+    def get_steps_for_roles(cls, state, roles):
+        """Return the steps that any of the roles can do in the state, in fsm order."""
+        if len(roles) == 1:
+            return cls.get_steps(state, next(iter(roles)))
+        steps = [step for role in roles for step in cls.get_steps(state, role)]
+        return tuple(sorted(steps, key=lambda step: step.index))
 
     @classmethod
     def get_create_roles(cls):
-        # FIXME: validate "None not found"
-        roles = []
-        for step in cls.fsm:
-            if step[0] is None:
-                roles.append(step[1])
-        return roles
+        return cls._fsm_table.create_roles
+
+    @classmethod
+    def bulk_transition(cls, queryset, step_index, values, user, batch_size=None):
+        """Move all the instances in the queryset through a step; see core.transitions."""
+        from core import transitions  # it uses these models
+        kwargs = {} if batch_size is None else {'batch_size': batch_size}
+        return transitions.bulk_apply_step(
+            queryset, cls.get_step_by_index(step_index), values, user, **kwargs)
 
     def get_current_steps(self, role):
         return self.get_steps(self.state, role)
 
 
+# what is still to be received for an Income
+OUTSTANDING = ExpressionWrapper(
+    F('category__amount') - F('total_received'),
+    output_field=DecimalField(max_digits=20, decimal_places=2))
+
+
+class IncomeQuerySet(FSMQuerySet):
+
+    def with_outstanding(self):
+        """Annotate the amount still to be received, to filter or sort by it."""
+        return self.annotate(outstanding=OUTSTANDING)
+
+
 class Income(FSMModel):
     """An income of money to a given event."""
 
@@ -131,6 +234,7 @@ class Income(FSMModel):
         (S_PARTIAL_PAYMENT, "Partial payment received, need more"),
     )
     state = CharField(max_length=256, choices=STATE_CHOICES)
+    version = PositiveIntegerField(default=0, editable=False)
 
     # fields with data
     event = ForeignKey(Event, on_delete=CASCADE)  # FIXME: limit to: Organizer
@@ -142,16 +246,48 @@ class Income(FSMModel):
     # payments_received = ManyToManyField(PaymentDone)
     extra_docs = ManyToManyField(ExtraDocument)  # really OneToMany, but this will do
 
+    # sum of all the payments_received, kept updated by PaymentReceived
+    total_received = DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+
+    objects = IncomeQuerySet.as_manager()
+
+    # amounts computed by the database when loading the instance for the flow pages
+    fsm_totals = {
+        'received': F('total_received'),
+        'outstanding': OUTSTANDING,
+    }
+
+    # the columns of the accounting exports: (header, lookup)
+    fsm_export = (
+        ('pk', 'pk'),
+        ('state', 'state'),
+        ('event', 'event__name'),
+        ('sponsor', 'sponsor__name'),
+        ('category', 'category__name'),
+        ('category_amount', 'category__amount'),
+        ('invoice_kind', 'invoice__kind'),
+        ('invoice_date', 'invoice__date'),
+        ('invoice_amount', 'invoice__amount'),
+        ('total_received', 'total_received'),
+    )
+
+    # the texts its flows are found by in the search (see `core.search`)
+    fsm_search = (
+        'event__name', 'sponsor__name', 'category__name', 'invoice__kind', 'invoice__amount')
+
     @property
     def total_payments(self):
-        return sum(p.amount for p in self.payments_received)
+        return self.total_received
 
     # fsm is a state machine, each node has:
     # - the current state (None is special, it's "non created", have all the info
     #   for the first creation of the instance)
     # - who needs to work on this state (do something so the flow can progress)
-    # - the next state after all info is supplied (None is special: means "done", "closed")
+    # - the next state after all info is supplied (the flow is done, "closed", when it
+    #   reaches the `fsm_final_state`, a state (or states) with no steps leaving it)
     # - all the fields that the user can work/change/use in that state
+    # (the model also needs the `state` and `version` fields, the latter is increased on
+    # each transition so concurrent ones can be detected)
     fsm = [
         (None, ORGZER, S_INIT, ['event', 'sponsor', 'category']),
         (S_INIT, ADMIN, S_HAVE_INVOICE, ['invoice']),
@@ -163,6 +299,153 @@ class Income(FSMModel):
     fsm_final_state = S_PAYMENT_DONE
 
 
+class WorkItem(Model):
+    """A flow that is waiting for a role to work on it.
+
+    It's a denormalization of the FSM models' states (one item per role that needs to work on
+    the instance's current state), kept in sync by `core.transitions`, so the home pages are a
+    single indexed query. Rebuild it with `manage.py rebuild_workitems`.
+    """
+    role = CharField(max_length=256)
+    model = CharField(max_length=256)
+    object_pk = IntegerField()
+    state = CharField(max_length=256)
+    since = DateTimeField()
+
+    class Meta:
+        indexes = [
+            Index(fields=['role', 'since']),
+            Index(fields=['model', 'object_pk']),
+        ]
+
+
+class Transition(Model):
+    """A state change of a FSM model instance, creation included.
+
+    This is an append only log (existing records can't be saved again), written by
+    `core.transitions` in the same transaction as the change.
+    """
+    model = CharField(max_length=256)
+    object_pk = IntegerField()
+    from_state = CharField(max_length=256, null=True)
+    to_state = CharField(max_length=256)
+    step_index = IntegerField(null=True)  # None for the changes outside the flow
+    user = ForeignKey(User, null=True, on_delete=SET_NULL)
+    time = DateTimeField()
+
+    class Meta:
+        indexes = [
+            Index(fields=['model', 'object_pk', 'time']),
+            Index(fields=['user', 'time']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Transitions can't be changed once recorded")
+        super().save(*args, **kwargs)
+
+
+class PendingNotification(Model):
+    """A transition not notified yet by mail (the outbox drained by `core.notifications`)."""
+    transition = OneToOneField(Transition, on_delete=CASCADE)
+
+
+class ArchiveQuerySet(QuerySet):
+    """Archived rows are read only, they are only written (inserted) by `core.archiving`."""
+
+    def update(self, **kwargs):
+        raise TypeError("Archived rows can't be changed")
+
+    def delete(self):
+        raise TypeError("Archived rows can't be deleted")
+
+    def union_hot(self, *fields, **filters):
+        """Return the values of the fields of the hot and archived rows that match the filters.
+
+        Each row also has `is_archived`, True for the archived ones.
+        """
+        hot = self.model.archive_of.objects.filter(**filters).values(
+            *fields, is_archived=Value(False))
+        cold = self.filter(**filters).values(*fields, is_archived=Value(True))
+        return hot.union(cold, all=True)
+
+
+class ArchiveModel(Model):
+    """Base for the archive tables: read only, keeping the original pks."""
+
+    id = IntegerField(primary_key=True)
+
+    objects = ArchiveQuerySet.as_manager()
+
+    # the model whose rows are archived here
+    archive_of = None
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        raise TypeError("Archived rows can't be saved, see core.archiving")
+
+    def delete(self, *args, **kwargs):
+        raise TypeError("Archived rows can't be deleted")
+
+
+class IncomeArchive(ArchiveModel):
+    """A finished Income, moved out of the hot tables (see `core.archiving`)."""
+    archive_of = Income
+
+    state = CharField(max_length=256, choices=Income.STATE_CHOICES)
+    version = PositiveIntegerField()
+    # the deletions of related rows don't go through ArchiveQuerySet, so they are refused
+    event = ForeignKey(Event, on_delete=PROTECT, related_name='+')
+    sponsor = ForeignKey(Sponsor, on_delete=PROTECT, related_name='+')
+    category = ForeignKey(Category, on_delete=PROTECT, related_name='+')
+    invoice = ForeignKey(Invoice, on_delete=PROTECT, null=True, related_name='+')
+    ready_to_payment = BooleanField(null=True)
+    payment_done = BooleanField(null=True)
+    extra_docs = ManyToManyField(
+        ExtraDocument, through='IncomeArchiveExtraDoc', related_name='+')
+    total_received = DecimalField(max_digits=20, decimal_places=2)
+    archived = DateTimeField()
+
+
+class IncomeArchiveExtraDoc(Model):
+    """The extra documents of an archived Income (protected like its other related rows)."""
+    incomearchive = ForeignKey(IncomeArchive, on_delete=PROTECT, related_name='+')
+    extradocument = ForeignKey(ExtraDocument, on_delete=PROTECT, related_name='+')
+
+    class Meta:
+        db_table = 'core_incomearchive_extra_docs'
+        unique_together = [('incomearchive', 'extradocument')]
+
+
+class PaymentArchive(ArchiveModel):
+    """A payment of an archived Income."""
+    archive_of = PaymentReceived
+
+    timestamp = DateTimeField()
+    amount = DecimalField(max_digits=20, decimal_places=2)
+    income = ForeignKey(IncomeArchive, related_name='payments_received', on_delete=PROTECT)
+
+
+class TransitionArchive(ArchiveModel):
+    """A Transition of an archived flow."""
+    archive_of = Transition
+
+    model = CharField(max_length=256)
+    object_pk = IntegerField()
+    from_state = CharField(max_length=256, null=True)
+    to_state = CharField(max_length=256)
+    step_index = IntegerField(null=True)  # None for the changes outside the flow
+    user = ForeignKey(User, null=True, on_delete=SET_NULL, related_name='+')
+    time = DateTimeField()
+
+    class Meta:
+        indexes = [
+            Index(fields=['model', 'object_pk', 'time']),
+        ]
+
+
 # How it works / extra considerations:
 # - on each state, it's presented to the user:
 #     - all the instance info so far (everything that is already not null)
@@ -186,6 +469,7 @@ class Income(FSMModel):
 #     # state related fields
 #     S_INIT = 'init'
 #     S_PAYMENT_DONE = 'payment-done'
+#     S_CLOSED = 'closed'
 #     STATE_CHOICES = (
 #         # ... all S_* above ...
 #     )
@@ -203,13 +487,15 @@ class Income(FSMModel):
 #     # - the current state (None is special, it's "non created", have all the info
 #     #   for the first creation of the instance)
 #     # - who needs to work on this state (do something so the flow can progress)
-#     # - the next state after all info is supplied (None is special: means "done", "closed")
+#     # - the next state after all info is supplied (the flow is done, "closed", when it
+    #   reaches the `fsm_final_state`, a state (or states) with no steps leaving it)
 #     # - all the fields that the user can work/change/use in that state
 #     fsm = [
 #         (None, ORGZER, S_INIT, [event, provider, description, invoice, comments]),
 #         (S_INIT, ADMIN, S_PAYMENT_DONE, [payment_receipt]),
-#         (S_PAYMENT_DONE, ORGZER, None, []),
+#         (S_PAYMENT_DONE, ORGZER, S_CLOSED, []),
 #     ]
+#     fsm_final_state = S_CLOSED
 #
 #
 # class Refund(Model):
@@ -218,6 +504,7 @@ class Income(FSMModel):
 #     # state related fields
 #     S_INIT = 'init'
 #     S_PAYMENT_DONE = 'payment-done'
+#     S_CLOSED = 'closed'
 #     STATE_CHOICES = (
 #         # ... all S_* above ...
 #     )
@@ -247,11 +534,13 @@ class Income(FSMModel):
 #     # - the current state (None is special, it's "non created", have all the info
 #     #   for the first creation of the instance)
 #     # - who needs to work on this state (do something so the flow can progress)
-#     # - the next state after all info is supplied (None is special: means "done", "closed")
+#     # - the next state after all info is supplied (the flow is done, "closed", when it
+    #   reaches the `fsm_final_state`, a state (or states) with no steps leaving it)
 #     # - all the fields that the user can work/change/use in that state
 #     fsm = [
 #         (None, ORGZER, S_INIT, [event, provider, description, invoices, comments]),
 #         (S_INIT, ADMIN, S_PAYMENT_DONE, [payment_receipt]),
-#         (S_PAYMENT_DONE, ORGZER, None, []),
+#         (S_PAYMENT_DONE, ORGZER, S_CLOSED, []),
 #     ]
+#     fsm_final_state = S_CLOSED
 #
@@ -0,0 +1,93 @@
+"""Mails to organizers and admins about the state changes.
+
+The transitions only queue a PendingNotification (in their own transaction), and these are
+sent later, off the request path, by `manage.py send_notifications`: in batches, with one
+digest mail per recipient for all the transitions of the batch, and one connection to the
+mail server per batch.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections
+
+from core import roles
+from core.models import ADMIN, ORGZER, PendingNotification
+
+# who receives the mails
+RECIPIENT_ROLES = (ORGZER, ADMIN)
+
+
+def get_recipients():
+    """Return the mail addresses of all the users that must be notified."""
+    users = roles.users_with_roles(RECIPIENT_ROLES).filter(is_active=True).exclude(email='')
+    return sorted(set(users.values_list('email', flat=True)))
+
+
+def build_digest(transitions):
+    """Return the subject and body of a mail that tells about all the given transitions."""
+    if len(transitions) == 1:
+        subject = "A flow changed its state"
+    else:
+        subject = "{} flows changed their state".format(len(transitions))
+    lines = []
+    for transition in transitions:
+        lines.append("{} {}: {} -> {} by {} at {:%Y-%m-%d %H:%M}".format(
+            transition.model, transition.object_pk, transition.from_state or "(created)",
+            transition.to_state, transition.user or "unknown", transition.time))
+    return subject, "\n".join(lines) + "\n"
+
+
+def send_batch(notification_ids):
+    """Send the digests for those pending notifications and remove them from the outbox.
+
+    No transaction is kept open while talking to the mail server; the notifications are
+    removed only after the mails were sent (so a failure means they're retried later).
+    Return how many mails were sent.
+    """
+    pending = list(
+        PendingNotification.objects.filter(pk__in=notification_ids)
+        .select_related('transition__user').order_by('transition__time', 'pk'))
+    if not pending:
+        return 0
+    subject, body = build_digest([notification.transition for notification in pending])
+    messages = [EmailMessage(subject, body, to=[email]) for email in get_recipients()]
+    if messages:
+        with get_connection() as connection:
+            connection.send_messages(messages)
+    PendingNotification.objects.filter(
+        pk__in=[notification.pk for notification in pending]).delete()
+    return len(messages)
+
+
+def _send_batch_in_worker(notification_ids):
+    try:
+        return send_batch(notification_ids)
+    finally:
+        # each worker thread (or process) has its own connections
+        connections.close_all()
+
+
+def _pending_batches(batch_size):
+    ids = list(PendingNotification.objects.order_by('pk').values_list('pk', flat=True))
+    return [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+
+
+def drain(batch_size=100, workers=0, processes=False):
+    """Send everything that is in the outbox; return how many mails were sent.
+
+    With workers the batches are sent in parallel by a pool of threads (or processes);
+    only one drain must run at a time.
+    """
+    batches = _pending_batches(batch_size)
+    if not workers:
+        return sum(send_batch(batch) for batch in batches)
+
+    if processes:
+        # the children must not share the parent's database connections
+        connections.close_all()
+        executor_class = ProcessPoolExecutor
+    else:
+        executor_class = ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        return sum(executor.map(_send_batch_in_worker, batches))
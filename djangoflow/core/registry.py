@@ -0,0 +1,63 @@
+"""Registry of the FSMModel subclasses of all the installed apps.
+
+It's filled once when the apps are ready (see `CoreConfig.ready`), so request time code
+never needs to introspect modules to find the flows.
+"""
+
+import hashlib
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+
+_models_by_name = {}
+_create_models_by_role = {}
+_signature = []
+
+
+def populate():
+    """Discover all the concrete FSMModel subclasses in the installed apps."""
+    from core.models import FSMModel
+
+    models_by_name = {}
+    create_models_by_role = {}
+    for model in apps.get_models():
+        if model is FSMModel or not issubclass(model, FSMModel) or model._fsm_table is None:
+            continue
+        name = model.__name__
+        if name in models_by_name:
+            raise ImproperlyConfigured("Two FSM models are named {!r}: {} and {}".format(
+                name, models_by_name[name]._meta.label, model._meta.label))
+        models_by_name[name] = model
+        for role in model.get_create_roles():
+            create_models_by_role.setdefault(role, []).append(model)
+
+    _models_by_name.clear()
+    _models_by_name.update(models_by_name)
+    _create_models_by_role.clear()
+    _create_models_by_role.update(
+        (role, tuple(models)) for role, models in create_models_by_role.items())
+    definitions = repr(sorted((name, model.fsm) for name, model in models_by_name.items()))
+    _signature[:] = [hashlib.sha1(definitions.encode('utf8')).hexdigest()[:12]]
+
+
+def get_model(name):
+    """Return the FSM model with that name, raise LookupError if there is none."""
+    try:
+        return _models_by_name[name]
+    except KeyError:
+        raise LookupError("No FSM model named {!r}".format(name))
+
+
+def get_models():
+    """Return all the FSM models."""
+    return tuple(_models_by_name.values())
+
+
+def get_create_models(role):
+    """Return the FSM models that the given role can create."""
+    return _create_models_by_role.get(role, ())
+
+
+def get_signature():
+    """Return a short hash of all the FSM definitions (it changes if any of them change)."""
+    return _signature[0]
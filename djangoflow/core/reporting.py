@@ -0,0 +1,102 @@
+"""Reports about the flows, computed by the database.
+
+Counts and money totals are grouped queries (`values().annotate()`), and the time spent in
+each state comes from the Transition history, pairing each transition with the next one of
+the same instance through a window function.
+"""
+
+from django.db import connection
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Sum, Window
+from django.db.models.functions import Lead
+
+from core import registry
+from core.models import Income, Transition
+
+# the percentiles reported for the time in each state
+PERCENTILES = (50, 90, 99)
+
+# how the money can be grouped, and the field with the name to show for each group
+MONEY_GROUPS = {
+    'event': 'event__name',
+    'sponsor': 'sponsor__name',
+    'category': 'category__name',
+}
+
+
+def state_counts():
+    """Return {model name: {state: how many instances}} for all the FSM models."""
+    counts = {}
+    for model in registry.get_models():
+        rows = model.objects.order_by().values('state').annotate(count=Count('pk'))
+        counts[model.__name__] = {row['state']: row['count'] for row in rows}
+    return counts
+
+
+def money_totals(group):
+    """Return the incomes, the money expected (category amounts) and received, per group.
+
+    The group is one of MONEY_GROUPS; each row is a dict with id, name, incomes, expected
+    and received.
+    """
+    name_field = MONEY_GROUPS[group]
+    rows = Income.objects.order_by(group).values(group, name_field).annotate(
+        incomes=Count('pk'), expected=Sum('category__amount'),
+        received=Sum('total_received'))
+    return [{
+        'id': row[group],
+        'name': row[name_field],
+        'incomes': row['incomes'],
+        'expected': row['expected'],
+        'received': row['received'],
+    } for row in rows]
+
+
+def time_in_state(model):
+    """Return {state: {'count': n, 'p50': timedelta, ...}} for the stays already finished.
+
+    A stay starts with the transition into the state and ends with the next transition
+    of the same instance (found with a LEAD window over the instance's history). The
+    percentiles are picked by the database too (nearest rank, from a ROW_NUMBER window per
+    state), so only a few rows per state are read, however long the history is.
+    """
+    stays = Transition.objects.filter(model=model.__name__).annotate(
+        duration=ExpressionWrapper(
+            Window(Lead('time'), partition_by=[F('object_pk')], order_by=F('time').asc())
+            - F('time'),
+            output_field=DurationField()),
+    ).values_list('to_state', 'duration')
+    stays_sql, params = stays.query.sql_with_params()
+    # the nearest rank of the percentile p among n values is ceil(n * p / 100)
+    ranks = ', '.join('(total * {} + 99) / 100'.format(percent) for percent in PERCENTILES)
+    sql = (
+        'SELECT to_state, duration, position, total FROM ('
+        ' SELECT to_state, duration,'
+        '  ROW_NUMBER() OVER (PARTITION BY to_state ORDER BY duration) AS position,'
+        '  COUNT(*) OVER (PARTITION BY to_state) AS total'
+        ' FROM ({}) stays WHERE duration IS NOT NULL'
+        ') ranked WHERE position IN ({})'.format(stays_sql, ranks))
+    duration_field = DurationField()
+    converters = duration_field.get_db_converters(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    report = {}
+    for state, duration, position, total in rows:
+        for converter in converters:
+            duration = converter(duration, None, connection)
+        report.setdefault(state, {'count': total})
+        for percent in PERCENTILES:
+            if (total * percent + 99) // 100 == position:
+                report[state]['p{}'.format(percent)] = duration
+    return report
+
+
+def build_report():
+    """Return everything the reports dashboard shows."""
+    return {
+        'state_counts': state_counts(),
+        'money': {group: money_totals(group) for group in MONEY_GROUPS},
+        'time_in_state': {
+            model.__name__: time_in_state(model) for model in registry.get_models()},
+    }
@@ -0,0 +1,87 @@
+"""The roles of each user, resolved once and cached.
+
+A user has the role of their Profile, plus the ones of the groups named as a role (so a
+user can hold several). They are kept in Django's cache, dropped when the Profile or the
+user's groups change, and RolesMiddleware puts them in `request.roles` so the views never
+query them.
+"""
+
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+from core.models import Organizer, Profile
+
+ROLES_TIMEOUT = 60 * 60 * 24
+
+
+def _key(user_pk):
+    return 'flow:roles:{}'.format(user_pk)
+
+
+def all_roles():
+    return [role for role, _ in Profile._meta.get_field('security_clearance').choices]
+
+
+def get_roles(user):
+    """Return the frozenset of roles of the user (empty for anonymous users)."""
+    if not user.is_authenticated:
+        return frozenset()
+    roles = cache.get(_key(user.pk))
+    if roles is None:
+        roles = set(Profile.objects.filter(user=user).values_list(
+            'security_clearance', flat=True))
+        roles.update(user.groups.filter(name__in=all_roles()).values_list('name', flat=True))
+        roles = sorted(roles)
+        cache.set(_key(user.pk), roles, ROLES_TIMEOUT)
+    return frozenset(roles)
+
+
+def users_with_roles(roles):
+    """Return a queryset of the users that hold any of the roles (the same way as get_roles)."""
+    return User.objects.filter(
+        Q(profile__security_clearance__in=roles) | Q(groups__name__in=roles)).distinct()
+
+
+def forget(*user_pks):
+    """Drop the cached roles of the users."""
+    cache.delete_many([_key(pk) for pk in user_pks])
+
+
+class RolesMiddleware:
+    """Set `request.roles` (resolved when first used); put it after AuthenticationMiddleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.roles = SimpleLazyObject(lambda: get_roles(request.user))
+        return self.get_response(request)
+
+
+def _profile_changed(sender, instance, **kwargs):
+    forget(instance.user_id)
+
+
+for _sender in (Profile, Organizer):
+    post_save.connect(_profile_changed, sender=_sender)
+    post_delete.connect(_profile_changed, sender=_sender)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def _groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        forget(instance.pk)
+    elif action == 'pre_clear':
+        forget(*instance.user_set.values_list('pk', flat=True))
+    elif pk_set:
+        forget(*pk_set)
+
+
+@receiver([pre_save, pre_delete], sender=Group)
+def _group_changed(sender, instance, **kwargs):
+    if instance.pk is not None:
+        forget(*instance.user_set.values_list('pk', flat=True))
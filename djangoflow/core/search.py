@@ -0,0 +1,127 @@
+"""Full text search of the flows, on SQLite FTS5.
+
+Each FSM model with a `fsm_search` (lookups of the texts to find its instances by) has an
+FTS5 table with one document per instance (its rowid is the instance pk). The documents
+are updated when an instance is saved or changes state (see `core.transitions`), and when
+a related object named in the lookups is saved; `manage.py rebuild_search_index` rebuilds
+them all.
+
+The queries are ranked (bm25) and match words by prefix.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models.signals import post_save
+
+from core import registry
+
+# documents written per query
+BATCH_SIZE = 1000
+
+# how many results are returned by default
+LIMIT = 20
+
+_WORD = re.compile(r'\w+')
+
+
+def is_enabled(model):
+    return connection.vendor == 'sqlite' and bool(getattr(model, 'fsm_search', None))
+
+
+def table_name(model):
+    return 'core_search_{}'.format(model._meta.model_name)
+
+
+def create_table(model, schema_editor=None):
+    """Create the search table of the model, if it's not there yet."""
+    sql = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(body, prefix='2 3', "
+        "tokenize='unicode61 remove_diacritics 2')".format(table_name(model)))
+    if schema_editor is not None:
+        schema_editor.execute(sql)
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+
+def _documents(queryset):
+    # (pk, text) for each instance
+    lookups = queryset.model.fsm_search
+    for row in queryset.values_list('pk', *lookups).iterator(chunk_size=BATCH_SIZE):
+        yield row[0], ' '.join(str(value) for value in row[1:] if value not in (None, ''))
+
+
+def _write(cursor, model, documents):
+    cursor.executemany(
+        'INSERT INTO {} (rowid, body) VALUES (%s, %s)'.format(table_name(model)), documents)
+
+
+def update(model, pks):
+    """Rebuild the documents of those instances of the model (dropping the deleted ones)."""
+    if not is_enabled(model) or not pks:
+        return
+    pks = list(pks)
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), BATCH_SIZE):
+            batch = pks[start:start + BATCH_SIZE]
+            cursor.execute('DELETE FROM {} WHERE rowid IN ({})'.format(
+                table_name(model), ', '.join(['%s'] * len(batch))), batch)
+            _write(cursor, model, list(_documents(model.objects.filter(pk__in=batch))))
+
+
+def rebuild(model):
+    """Rebuild all the documents of the model; return how many there are."""
+    create_table(model)
+    total = 0
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(table_name(model)))
+        documents = []
+        for document in _documents(model.objects.order_by('pk')):
+            documents.append(document)
+            if len(documents) >= BATCH_SIZE:
+                _write(cursor, model, documents)
+                total += len(documents)
+                documents = []
+        _write(cursor, model, documents)
+        total += len(documents)
+        cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(table_name(model)))
+    return total
+
+
+def to_match(text):
+    """Return the FTS5 query for the user's text: all its words, as prefixes."""
+    return ' '.join('"{}"*'.format(word) for word in _WORD.findall(text))
+
+
+def search(model, text, limit=LIMIT):
+    """Return the (pk, document) of the instances matching the text, best ranked first."""
+    match = to_match(text)
+    if not is_enabled(model) or not match:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT rowid, body FROM {0} WHERE {0} MATCH %s ORDER BY rank LIMIT %s'.format(
+                table_name(model)), [match, limit])
+        return cursor.fetchall()
+
+
+def connect():
+    """Keep the documents updated when the related objects of the instances are saved.
+
+    (the saves of the instances themselves are handled by `core.transitions`)
+    """
+    for model in registry.get_models():
+        if not getattr(model, 'fsm_search', None):
+            continue
+        related = {lookup.split('__')[0] for lookup in model.fsm_search if '__' in lookup}
+        for name in related:
+            field = model._meta.get_field(name)
+
+            def related_changed(sender, instance, model=model, name=name, **kwargs):
+                update(model, model.objects.filter(**{name: instance}).values_list(
+                    'pk', flat=True))
+
+            post_save.connect(
+                related_changed, sender=field.related_model, weak=False,
+                dispatch_uid=(model, name))
@@ -0,0 +1,59 @@
+// Search as you type for the related fields of the flow forms (see core.forms.LookupMixin):
+// the selects only come with the chosen option, the rest is fetched page by page.
+document.addEventListener('DOMContentLoaded', function () {
+  document.querySelectorAll('select[data-lookup-url]').forEach(function (select) {
+    var search = document.createElement('input');
+    var more = document.createElement('button');
+    var page = 1;
+    var timer = null;
+    search.type = 'search';
+    search.placeholder = 'Search...';
+    more.type = 'button';
+    more.textContent = 'More';
+    more.hidden = true;
+    select.parentNode.insertBefore(search, select);
+    select.parentNode.insertBefore(more, select.nextSibling);
+
+    function load(reset) {
+      var params = new URLSearchParams({q: search.value, page: page});
+      var scope = select.dataset.lookupScope;
+      if (scope && select.form.elements[scope]) {
+        params.set(scope, select.form.elements[scope].value);
+      }
+      fetch(select.dataset.lookupUrl + '?' + params).then(function (response) {
+        return response.json();
+      }).then(function (data) {
+        if (reset) {
+          Array.from(select.options).forEach(function (option) {
+            if (option.value && !option.selected) {
+              option.remove();
+            }
+          });
+        }
+        data.results.forEach(function (result) {
+          if (!select.querySelector('option[value="' + result.id + '"]')) {
+            select.add(new Option(result.text, result.id));
+          }
+        });
+        more.hidden = !data.more;
+      });
+    }
+
+    search.addEventListener('input', function () {
+      clearTimeout(timer);
+      timer = setTimeout(function () {
+        page = 1;
+        load(true);
+      }, 250);
+    });
+    select.addEventListener('focus', function () {
+      if (select.options.length <= 2) {
+        load(false);
+      }
+    }, {once: true});
+    more.addEventListener('click', function () {
+      page += 1;
+      load(false);
+    });
+  });
+});
@@ -0,0 +1,131 @@
+"""Content addressed storage for the uploaded images, and their smaller derivatives.
+
+Each upload is hashed while it's written in chunks and stored under its hash, so the same
+file uploaded many times (a common thing with invoice scans) is stored only once. After
+a new file is stored (and the transaction committed), its thumbnail and preview are made
+by a pool of background workers; the flow pages show those, falling back to the original
+while they are not ready (`manage.py build_derivatives` makes any missing ones).
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIR = 'blobs'
+DERIVED_DIR = 'derived'
+
+# the derivatives made for each image: name -> (max width, max height)
+DERIVATIVES = {
+    'thumb': (160, 160),
+    'preview': (1024, 1024),
+}
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """A file system storage that names the files by the SHA-256 of their content.
+
+    The derivatives are saved with the names given (see `derivative_name`).
+    """
+
+    def _save(self, name, content):
+        if name.startswith(DERIVED_DIR + '/'):
+            return super()._save(name, content)
+        # written to a temporary file while hashed, then linked under its hash, which is
+        # atomic and never replaces a file (so concurrent uploads of a file store it once)
+        os.makedirs(self.path(BLOBS_DIR), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path(BLOBS_DIR), prefix='.upload-')
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    fh.write(chunk)
+            hexdigest = digest.hexdigest()
+            extension = os.path.splitext(name)[1].lower()
+            name = '/'.join([BLOBS_DIR, hexdigest[:2], hexdigest[2:4], hexdigest + extension])
+            path = self.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(temp_path, self.file_permissions_mode or 0o644)
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                return name
+        finally:
+            os.unlink(temp_path)
+        transaction.on_commit(partial(schedule_derivatives, name))
+        return name
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def derivative_name(name, kind):
+    """Return the name of the derivative of that kind of a stored image."""
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return '/'.join([DERIVED_DIR, kind, stem[:2], stem + '.jpg'])
+
+
+def make_derivatives(name, storage=blob_storage):
+    """Make all the missing derivatives of the stored image (files that aren't are skipped)."""
+    missing = [
+        kind for kind in DERIVATIVES if not storage.exists(derivative_name(name, kind))]
+    if not missing:
+        return
+    try:
+        with storage.open(name) as fh:
+            original = Image.open(fh)
+            original.load()
+    except (OSError, UnidentifiedImageError) as err:
+        logger.warning("Can't make derivatives of %s: %s", name, err)
+        return
+    for kind in missing:
+        image = original.convert('RGB')
+        image.thumbnail(DERIVATIVES[kind])
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        storage.save(derivative_name(name, kind), ContentFile(buffer.getvalue()))
+
+
+_pool = []
+
+
+def schedule_derivatives(name):
+    """Make the derivatives of the stored image in the background.
+
+    With FLOW_DERIVATIVE_WORKERS = 0 they are made right away instead.
+    """
+    workers = getattr(settings, 'FLOW_DERIVATIVE_WORKERS', 2)
+    if not workers:
+        make_derivatives(name)
+        return
+    if not _pool:
+        _pool.append(ThreadPoolExecutor(workers, thread_name_prefix='derivatives'))
+    future = _pool[0].submit(make_derivatives, name)
+    future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Making derivatives failed", exc_info=future.exception())
+
+
+def derivative_url(field_file, kind):
+    """Return the URL of the derivative of an image field's file, or of the original."""
+    name = derivative_name(field_file.name, kind)
+    if field_file.storage.exists(name):
+        return field_file.storage.url(name)
+    return field_file.url
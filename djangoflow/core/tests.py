@@ -1,3 +1,1020 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.db.models import ProtectedError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from core import (
+    caching, checks, forms, importing, metrics, notifications, registry, reporting, roles,
+    search, storage, transitions,
+)
+from core.fsm import compile_fsm
+from core.models import (
+    ADMIN, ORGZER, Category, Event, ExtraDocument, Income, IncomeArchive, Invoice,
+    PaymentArchive, PaymentReceived, PendingNotification, Profile, Sponsor, Transition,
+    TransitionArchive, WorkItem,
+)
+
+
+class TransitionTableTests(SimpleTestCase):
+
+    def test_income_table(self):
+        table = Income._fsm_table
+        self.assertEqual(table.create_roles, {ORGZER})
+        self.assertEqual(table.final_states, {Income.S_PAYMENT_DONE})
+        self.assertEqual(table.roles_by_state[Income.S_INIT], {ADMIN})
+        steps = Income.get_steps(Income.S_READY_TO_PAYMENT, ADMIN)
+        self.assertEqual([step.index for step in steps], [3, 4])
+        self.assertIs(Income.get_step_by_index(3), steps[0])
+        self.assertEqual(Income.get_steps(Income.S_READY_TO_PAYMENT, ORGZER), ())
+
+    def test_no_creation_step(self):
+        with self.assertRaises(ImproperlyConfigured):
+            compile_fsm('Bad', [('a', ADMIN, 'b', [])], 'b')
+
+    def test_malformed_step(self):
+        with self.assertRaises(ImproperlyConfigured):
+            compile_fsm('Bad', [(None, ADMIN, 'b')], 'b')
+        with self.assertRaisesMessage(ImproperlyConfigured, "fsm_final_state"):
+            compile_fsm('Bad', [(None, ADMIN, 'a', []), ('a', ADMIN, None, [])], 'a')
+
+    def test_unreachable_final_state(self):
+        with self.assertRaises(ImproperlyConfigured):
+            compile_fsm('Bad', [(None, ADMIN, 'a', [])], 'b')
+
+    def test_reachable(self):
+        fsm = [(None, ADMIN, 'a', []), ('a', ADMIN, 'b', []), ('c', ADMIN, 'b', [])]
+        table = compile_fsm('Some', fsm, 'b')
+        self.assertEqual(table.reachable, {'a', 'b'})
+
+    def test_model_checks(self):
+        self.assertEqual(
+            [message.id for message in checks.check_model(Income)], ['core.W001'])
+        fsm = [
+            (None, ORGZER, Income.S_INIT, ['event', 'nope']),
+            (Income.S_INIT, ADMIN, Income.S_PAYMENT_DONE, []),
+            (Income.S_INIT, ADMIN, 'bogus', []),
+            (Income.S_INIT, ADMIN, Income.S_HAVE_INVOICE, []),
+            (Income.S_HAVE_INVOICE, ADMIN, Income.S_PARTIAL_PAYMENT, []),
+            (Income.S_PARTIAL_PAYMENT, ADMIN, Income.S_HAVE_INVOICE, []),
+            (Income.S_READY_TO_PAYMENT, ADMIN, Income.S_PAYMENT_DONE, []),
+        ]
+        table = compile_fsm('Income', fsm, Income.S_PAYMENT_DONE)
+        with patch.object(Income, '_fsm_table', table):
+            messages = checks.check_model(Income)
+        self.assertEqual(sorted(message.id for message in messages), [
+            'core.E002', 'core.E003', 'core.E004', 'core.E005',
+            'core.W002', 'core.W002', 'core.W003'])
+
+    def test_dot_graph(self):
+        out = StringIO()
+        call_command('fsm_graph', 'Income', stdout=out)
+        self.assertIn('"init" -> "have-invoice" [label="1: admin\\ninvoice"];', out.getvalue())
+
+    def test_steps_leaving_final_state(self):
+        fsm = [(None, ADMIN, 'a', []), ('a', ADMIN, 'b', [])]
+        with self.assertRaises(ImproperlyConfigured):
+            compile_fsm('Bad', fsm, 'a')
+
+
+class FlowTestCase(TestCase):
+    """Some events, sponsors and incomes, and a logged in user for each role."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.event = Event.objects.create(name="PyCon")
+        cls.sponsor = Sponsor.objects.create(name="ACME")
+        cls.category = Category.objects.create(name="Gold", amount=1000, event=cls.event)
+        cls.users = {}
+        for role in (ORGZER, ADMIN):
+            user = User.objects.create_user(role, password='secret')
+            Profile.objects.create(user=user, security_clearance=role)
+            cls.users[role] = user
+
+    def setUp(self):
+        cache.clear()
+
+    def create_income(self, state=Income.S_INIT):
+        # a flow from before the history (and the work items), unless recorded by the test
+        with transitions.recorded_saves():
+            return Income.objects.create(
+                state=state, event=self.event, sponsor=self.sponsor, category=self.category)
+
+
+class ActionableByTests(FlowTestCase):
+
+    def test_filters_by_role_states(self):
+        init = self.create_income(Income.S_INIT)
+        have_invoice = self.create_income(Income.S_HAVE_INVOICE)
+        ready = self.create_income(Income.S_READY_TO_PAYMENT)
+        self.create_income(Income.S_PAYMENT_DONE)
+        self.assertEqual(set(Income.objects.actionable_by(ADMIN)), {init, ready})
+        self.assertEqual(set(Income.objects.actionable_by(ORGZER)), {have_invoice})
+        self.assertFalse(Income.objects.actionable_by('nobody').exists())
+
+
+class RegistryTests(FlowTestCase):
+
+    def test_discovered_models(self):
+        self.assertEqual(registry.get_models(), (Income,))
+        self.assertIs(registry.get_model('Income'), Income)
+        self.assertEqual(registry.get_create_models(ORGZER), (Income,))
+        self.assertEqual(registry.get_create_models(ADMIN), ())
+        with self.assertRaises(LookupError):
+            registry.get_model('FSMModel')
+
+    def test_unknown_model_in_url(self):
+        self.client.force_login(self.users[ORGZER])
+        self.assertEqual(self.client.get('/flow/create/Income').status_code, 200)
+        self.assertEqual(self.client.get('/flow/create/Profile').status_code, 404)
+
+
+class FormCacheTests(SimpleTestCase):
+
+    def test_step_form_class_is_reused(self):
+        form_class = forms.get_step_form_class(Income, 0)
+        self.assertIs(forms.get_step_form_class(Income, 0), form_class)
+        self.assertEqual(list(form_class.base_fields), ['event', 'sponsor', 'category'])
+
+    def test_instance_form_is_read_only(self):
+        form_class = forms.get_instance_form_class(Income)
+        self.assertIs(forms.get_instance_form_class(Income), form_class)
+        self.assertTrue(all(field.disabled for field in form_class.base_fields.values()))
+
+
+class TransitionTests(FlowTestCase):
+
+    def create_through_view(self):
+        self.client.force_login(self.users[ORGZER])
+        response = self.client.post('/flow/create/Income/0/new', {
+            'event': self.event.pk, 'sponsor': self.sponsor.pk, 'category': self.category.pk})
+        self.assertRedirects(response, '/')
+        return Income.objects.get()
+
+    def test_create_adds_work_item(self):
+        income = self.create_through_view()
+        self.assertEqual(income.state, Income.S_INIT)
+        item = WorkItem.objects.get()
+        self.assertEqual(
+            (item.role, item.model, item.object_pk, item.state),
+            (ADMIN, 'Income', income.pk, Income.S_INIT))
+        transition = Transition.objects.get()
+        self.assertEqual((transition.from_state, transition.to_state), (None, Income.S_INIT))
+        self.assertEqual(item.since, transition.time)
+
+    def test_create_writes_work_items_and_search_once(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.create_through_view()
+        # (the home page it redirects to reads the work items too)
+        sqls = [
+            query['sql'] for query in captured.captured_queries
+            if not query['sql'].startswith('SELECT')]
+        self.assertEqual(len([sql for sql in sqls if 'core_workitem' in sql]), 2)
+        self.assertEqual(len([sql for sql in sqls if 'core_search_income' in sql]), 2)
+
+    def test_history_page(self):
+        income = self.create_through_view()
+        response = self.client.get('/flow/history/Income/{}'.format(income.pk))
+        self.assertContains(response, "(created) -&gt; init by organizer")
+
+    def test_transitions_are_append_only(self):
+        self.create_through_view()
+        with self.assertRaises(ValueError):
+            Transition.objects.get().save()
+
+    def test_step_updates_instance_and_work_items(self):
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        call_command('rebuild_workitems', stdout=StringIO())
+        self.client.force_login(self.users[ORGZER])
+        response = self.client.post(
+            '/flow/create/Income/2/{}'.format(income.pk), {'ready_to_payment': 'true'})
+        self.assertRedirects(response, '/')
+        income.refresh_from_db()
+        self.assertEqual(income.state, Income.S_READY_TO_PAYMENT)
+        self.assertTrue(income.ready_to_payment)
+        self.assertEqual(Income.objects.count(), 1)
+        self.assertEqual(
+            list(WorkItem.objects.values_list('role', 'state')),
+            [(ADMIN, Income.S_READY_TO_PAYMENT)])
+        transition = Transition.objects.get()
+        self.assertEqual(
+            (transition.object_pk, transition.from_state, transition.to_state,
+             transition.step_index, transition.user),
+            (income.pk, Income.S_HAVE_INVOICE, Income.S_READY_TO_PAYMENT, 2,
+             self.users[ORGZER]))
+
+    def test_step_from_other_state_or_role(self):
+        income = self.create_income(Income.S_INIT)
+        self.client.force_login(self.users[ORGZER])
+        url = '/flow/create/Income/2/{}'.format(income.pk)
+        self.assertEqual(self.client.post(url, {'ready_to_payment': 'true'}).status_code, 409)
+        self.client.force_login(self.users[ADMIN])
+        self.assertEqual(self.client.post(url, {'ready_to_payment': 'true'}).status_code, 403)
+        url = '/flow/create/Income/99/{}'.format(income.pk)
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+    def test_changes_outside_the_flow(self):
+        # e.g. in the admin
+        income = Income.objects.create(
+            state=Income.S_INIT, event=self.event, sponsor=self.sponsor, category=self.category)
+        self.assertEqual(
+            list(WorkItem.objects.values_list('role', 'state')), [(ADMIN, Income.S_INIT)])
+        income = Income.objects.get(pk=income.pk)
+        income.state = Income.S_HAVE_INVOICE
+        income.save()
+        self.assertEqual(
+            list(WorkItem.objects.values_list('role', 'state')),
+            [(ORGZER, Income.S_HAVE_INVOICE)])
+        income.save()
+        self.assertEqual(
+            list(Transition.objects.values_list('from_state', 'to_state', 'step_index')),
+            [(None, Income.S_INIT, None), (Income.S_INIT, Income.S_HAVE_INVOICE, None)])
+        self.sponsor.delete()
+        self.assertFalse(WorkItem.objects.exists())
+
+    def test_step_without_editable_fields(self):
+        # the partial payment step only works on the payments, a reverse relation
+        income = self.create_income(Income.S_READY_TO_PAYMENT)
+        self.client.force_login(self.users[ADMIN])
+        response = self.client.get('/flow/create/Income/{}'.format(income.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['forms'][1]['form'].fields), [])
+        self.client.post('/flow/create/Income/4/{}'.format(income.pk))
+        income.refresh_from_db()
+        self.assertEqual(income.state, Income.S_PARTIAL_PAYMENT)
+
+    def test_home_page_lists_work_items(self):
+        for _ in range(3):
+            self.create_income(Income.S_INIT)
+        self.create_income(Income.S_HAVE_INVOICE)
+        call_command('rebuild_workitems', stdout=StringIO())
+        self.client.force_login(self.users[ADMIN])
+        with patch('core.views.OPEN_PAGE_SIZE', 2):
+            response = self.client.get('/')
+            self.assertEqual(len(response.context['open']), 2)
+            response = self.client.get('/?page=2')
+            self.assertEqual(len(response.context['open']), 1)
+
+
+class NotificationTests(FlowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for role, user in self.users.items():
+            user.email = '{}@example.com'.format(role)
+            user.save()
+
+    def test_transitions_are_queued_and_sent_as_digests(self):
+        self.client.force_login(self.users[ORGZER])
+        for _ in range(3):
+            self.client.post('/flow/create/Income/0/new', {
+                'event': self.event.pk, 'sponsor': self.sponsor.pk,
+                'category': self.category.pk})
+        self.assertEqual(PendingNotification.objects.count(), 3)
+        self.assertEqual(mail.outbox, [])
+
+        call_command('send_notifications', '--batch-size=2', stdout=StringIO())
+        self.assertEqual(PendingNotification.objects.count(), 0)
+        # two batches, one digest for each recipient in each
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ['admin@example.com'] * 2 + ['organizer@example.com'] * 2)
+        self.assertEqual(mail.outbox[0].subject, "2 flows changed their state")
+        self.assertEqual(mail.outbox[0].body.count("(created) -> init by organizer"), 2)
+
+    def test_recipients_by_group_role(self):
+        user = User.objects.create_user('grouped', email='grouped@example.com')
+        user.groups.add(Group.objects.create(name=ADMIN))
+        self.assertEqual(notifications.get_recipients(), [
+            'admin@example.com', 'grouped@example.com', 'organizer@example.com'])
+
+
+class BulkTransitionTests(FlowTestCase):
+
+    def test_moves_valid_rows_and_reports_the_others(self):
+        ready = [self.create_income(Income.S_READY_TO_PAYMENT) for _ in range(5)]
+        other = self.create_income(Income.S_INIT)
+        call_command('rebuild_workitems', stdout=StringIO())
+        queryset = Income.objects.filter(pk__in=[income.pk for income in ready + [other]])
+
+        result = Income.bulk_transition(
+            queryset, 3, {'payment_done': 'true'}, self.users[ADMIN], batch_size=2)
+        self.assertEqual(sorted(result.done), [income.pk for income in ready])
+        self.assertEqual(list(result.failed), [other.pk])
+        self.assertEqual(
+            Income.objects.filter(state=Income.S_PAYMENT_DONE, payment_done=True).count(), 5)
+        self.assertEqual(Transition.objects.filter(step_index=3).count(), 5)
+        self.assertEqual(PendingNotification.objects.count(), 5)
+        self.assertEqual(list(WorkItem.objects.values_list('object_pk', flat=True)), [other.pk])
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            Income.bulk_transition(Income.objects.all(), 3, {'invoice': 1}, None)
+        with self.assertRaises(ValueError):
+            Income.bulk_transition(Income.objects.all(), 5, {'extra_docs': []}, None)
+        income = self.create_income(Income.S_INIT)
+        # the invoice is required in its step
+        with self.assertRaises(ValueError):
+            Income.bulk_transition(Income.objects.all(), 1, {}, None)
+        income.refresh_from_db()
+        self.assertEqual(income.state, Income.S_INIT)
+
+    def test_command(self):
+        self.create_income(Income.S_READY_TO_PAYMENT)
+        stdout = StringIO()
+        call_command(
+            'bulk_transition', 'Income', '3', '--set=payment_done=true', '--user=admin',
+            stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Moved 1 to 'payment-done', 0 failed.\n")
+
+
+class ConcurrencyTests(FlowTestCase):
+
+    def test_stale_version_is_a_conflict(self):
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        self.client.force_login(self.users[ORGZER])
+        url = '/flow/create/Income/2/{}'.format(income.pk)
+        response = self.client.post(url, {'ready_to_payment': 'true', 'fsm_version': '7'})
+        self.assertEqual(response.status_code, 409)
+        income.refresh_from_db()
+        self.assertEqual((income.state, income.version), (Income.S_HAVE_INVOICE, 0))
+        self.assertFalse(Transition.objects.exists())
+
+        response = self.client.post(url, {'ready_to_payment': 'true', 'fsm_version': '0'})
+        self.assertRedirects(response, '/')
+        income.refresh_from_db()
+        self.assertEqual((income.state, income.version), (Income.S_READY_TO_PAYMENT, 1))
+
+
+class ConcurrencyStressTests(TransactionTestCase):
+    """Several threads racing to move the same flows: each move must win exactly once."""
+
+    threads = 8
+    incomes = 20
+
+    def setUp(self):
+        event = Event.objects.create(name="PyCon")
+        category = Category.objects.create(name="Gold", amount=1000, event=event)
+        sponsor = Sponsor.objects.create(name="ACME")
+        with transitions.recorded_saves():
+            self.pks = [
+                Income.objects.create(
+                    state=Income.S_READY_TO_PAYMENT, event=event, sponsor=sponsor,
+                    category=category).pk
+                for _ in range(self.incomes)]
+
+    def race(self, worker):
+        # the two outcomes of ready-to-payment, for the admin
+        step = Income.get_step_by_index(3 if worker % 2 else 4)
+        won = 0
+        try:
+            for pk in self.pks:
+                while True:
+                    try:
+                        instance = Income.objects.get(pk=pk)
+                        form = forms.get_step_form_class(Income, step.index)(
+                            {'payment_done': 'true'}, instance=instance)
+                        form.is_valid()
+                        transitions.apply_step(step, form, None, expected_version=0)
+                    except transitions.TransitionConflict:
+                        break
+                    except OperationalError:
+                        continue  # the database is busy (SQLite), try again
+                    won += 1
+                    break
+        finally:
+            connections.close_all()
+        return won
+
+    def test_no_lost_updates(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.threads) as executor:
+            wins = sum(executor.map(self.race, range(self.threads)))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(wins, self.incomes)
+        self.assertFalse(Income.objects.exclude(version=1).exists())
+        self.assertEqual(Transition.objects.count(), self.incomes)
+        # one work item per moved flow (the partial payment ones wait for the organizer)
+        self.assertEqual(WorkItem.objects.count(), Income.objects.filter(
+            state=Income.S_PARTIAL_PAYMENT).count())
+        self.assertLess(elapsed, 30)
+
+
+class DetailQueriesTests(FlowTestCase):
+
+    def add_data(self, income, count):
+        for i in range(count):
+            Sponsor.objects.create(name="Sponsor {}".format(i))
+            Category.objects.create(name="Cat {}".format(i), amount=i, event=self.event)
+            income.extra_docs.add(ExtraDocument.objects.create(image='doc.png', comment="c"))
+            income.payments_received.create(timestamp=timezone.now(), amount=10)
+
+    def test_fixed_number_of_queries(self):
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        self.client.force_login(self.users[ORGZER])
+        url = '/flow/create/Income/{}'.format(income.pk)
+        self.add_data(income, 1)
+        self.client.get('/')  # caches the user's roles
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url)
+        self.assertEqual(
+            response.context['totals'], [('received', 10), ('outstanding', 990)])
+
+        self.add_data(income, 20)
+        # session, user, the income with its relations, extra docs, payments
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEqual(len(few), 5)
+        self.assertEqual(
+            response.context['totals'], [('received', 210), ('outstanding', 790)])
+        self.assertContains(response, '<span>Sponsor object (1)</span>', html=True)
+        self.assertNotContains(response, '<option value="3">')
+
+
+class TotalReceivedTests(FlowTestCase):
+
+    def total(self, income):
+        income.refresh_from_db()
+        return income.total_received
+
+    def test_kept_updated_by_the_payments(self):
+        income = self.create_income()
+        other = self.create_income()
+        payment = income.payments_received.create(timestamp=timezone.now(), amount=100)
+        income.payments_received.create(timestamp=timezone.now(), amount=50)
+        self.assertEqual(self.total(income), 150)
+
+        payment = PaymentReceived.objects.get(pk=payment.pk)
+        payment.amount = 70
+        payment.save()
+        self.assertEqual(self.total(income), 120)
+
+        payment.income = other
+        payment.save()
+        self.assertEqual((self.total(income), self.total(other)), (50, 70))
+
+        payment.delete()
+        self.assertEqual(self.total(other), 0)
+        self.assertEqual(other.total_payments, 0)
+
+    def test_saves_of_unloaded_or_partial_payments(self):
+        income = self.create_income()
+        payment = income.payments_received.create(timestamp=timezone.now(), amount=5)
+        PaymentReceived(
+            pk=payment.pk, timestamp=timezone.now(), amount=7, income=income).save()
+        self.assertEqual(self.total(income), 7)
+        payment = PaymentReceived.objects.get(pk=payment.pk)
+        payment.amount = 100
+        payment.save(update_fields=['timestamp'])
+        self.assertEqual(self.total(income), 7)
+
+    def test_outstanding(self):
+        paid = self.create_income()
+        paid.payments_received.create(timestamp=timezone.now(), amount=1000)
+        partial = self.create_income()
+        partial.payments_received.create(timestamp=timezone.now(), amount=300)
+        queryset = Income.objects.with_outstanding()
+        self.assertEqual(
+            list(queryset.filter(outstanding__gt=0).values_list('pk', 'outstanding')),
+            [(partial.pk, 700)])
+        self.assertEqual(
+            list(queryset.order_by('outstanding').values_list('pk', flat=True)),
+            [paid.pk, partial.pk])
+
+    def test_reconcile(self):
+        income = self.create_income()
+        income.payments_received.create(timestamp=timezone.now(), amount=100)
+        PaymentReceived.objects.update(amount=40)
+        stdout = StringIO()
+        call_command('reconcile_totals', stdout=stdout)
+        self.assertEqual(stdout.getvalue().splitlines()[-1], "1 incomes fixed.")
+        self.assertEqual(self.total(income), 40)
+
+
+class LookupTests(FlowTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_event = Event.objects.create(name="Other")
+        cls.other_category = Category.objects.create(
+            name="Other gold", amount=10, event=cls.other_event)
+        Sponsor.objects.bulk_create(Sponsor(name="Sponsor {}".format(i)) for i in range(30))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.users[ORGZER])
+
+    def test_create_page_does_not_render_the_options(self):
+        response = self.client.get('/flow/create/Income')
+        self.assertNotContains(response, 'Sponsor object')
+        self.assertContains(response, 'data-lookup-url="/flow/lookup/Income/sponsor"')
+        self.assertContains(response, 'data-lookup-scope="event"')
+        self.assertContains(response, 'core/lookup.js', count=1)
+
+    def test_paginated_search(self):
+        response = self.client.get('/flow/lookup/Income/sponsor', {'q': 'sponsor 1'})
+        self.assertEqual(
+            [result['id'] for result in response.json()['results']],
+            list(Sponsor.objects.filter(name__startswith='Sponsor 1').values_list(
+                'pk', flat=True)))
+        first = self.client.get('/flow/lookup/Income/sponsor').json()
+        second = self.client.get('/flow/lookup/Income/sponsor', {'page': 2}).json()
+        self.assertEqual((len(first['results']), first['more']), (20, True))
+        self.assertEqual((len(second['results']), second['more']), (11, False))
+
+    def test_category_scoped_by_event(self):
+        response = self.client.get(
+            '/flow/lookup/Income/category', {'event': self.other_event.pk})
+        self.assertEqual(
+            response.json()['results'], [{'id': self.other_category.pk, 'text': str(
+                self.other_category)}])
+        self.assertEqual(self.client.get('/flow/lookup/Income/state').status_code, 404)
+        self.assertEqual(self.client.get('/flow/lookup/Income/nope').status_code, 404)
+
+    def test_form_rejects_category_of_other_event(self):
+        form_class = forms.get_step_form_class(Income, 0)
+        form = form_class({
+            'event': self.event.pk, 'sponsor': self.sponsor.pk,
+            'category': self.other_category.pk})
+        self.assertEqual(list(form.errors), ['category'])
+
+        response = self.client.post('/flow/create/Income/0/new', {
+            'event': self.event.pk, 'sponsor': self.sponsor.pk,
+            'category': self.other_category.pk})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.context['forms'][0]['form'].errors), ['category'])
+        self.assertFalse(Income.objects.exists())
+
+    def test_invalid_scope_value_is_ignored(self):
+        response = self.client.get('/flow/lookup/Income/category', {'event': 'abc'})
+        self.assertEqual(len(response.json()['results']), 2)
+
+
+class APITests(FlowTestCase):
+
+    def post_json(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_requires_login(self):
+        self.assertEqual(self.client.get('/api/flows/Income').status_code, 401)
+
+    def test_keyset_pagination(self):
+        incomes = [self.create_income(Income.S_INIT) for _ in range(5)]
+        self.create_income(Income.S_HAVE_INVOICE)
+        self.client.force_login(self.users[ADMIN])
+        page = self.client.get('/api/flows/Income', {'limit': 3}).json()
+        self.assertEqual([row['pk'] for row in page['results']], [i.pk for i in incomes[:3]])
+        page = self.client.get(page['next']).json()
+        self.assertEqual([row['pk'] for row in page['results']], [i.pk for i in incomes[3:]])
+        self.assertIsNone(page['next'])
+        for limit in (0, -1, -5):
+            response = self.client.get('/api/flows/Income', {'limit': limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_streamed_export(self):
+        incomes = [self.create_income(Income.S_INIT) for _ in range(3)]
+        self.client.force_login(self.users[ADMIN])
+        response = self.client.get('/api/flows/Income/export')
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(rows, [
+            {'pk': income.pk, 'state': Income.S_INIT, 'version': 0} for income in incomes])
+
+    def test_create_detail_and_step(self):
+        self.client.force_login(self.users[ORGZER])
+        response = self.post_json('/api/flows/Income/steps/0', {
+            'event': self.event.pk, 'sponsor': self.sponsor.pk, 'category': self.category.pk})
+        self.assertEqual(response.status_code, 201)
+        pk = response.json()['pk']
+        Income.objects.filter(pk=pk).update(state=Income.S_HAVE_INVOICE)
+
+        detail = self.client.get('/api/flows/Income/{}'.format(pk)).json()
+        self.assertEqual(detail['sponsor_id'], self.sponsor.pk)
+        self.assertEqual(detail['extra_docs'], [])
+        self.assertEqual(
+            detail['steps'],
+            [{'index': 2, 'next_state': Income.S_READY_TO_PAYMENT,
+              'fields': ['ready_to_payment']}])
+
+        url = '/api/flows/Income/{}/steps/2'.format(pk)
+        response = self.post_json(url, {'ready_to_payment': True, 'version': 5})
+        self.assertEqual(response.status_code, 409)
+        response = self.post_json(url, {'ready_to_payment': True, 'version': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], Income.S_READY_TO_PAYMENT)
+
+    def test_invalid_step_data(self):
+        self.client.force_login(self.users[ORGZER])
+        response = self.post_json('/api/flows/Income/steps/0', {'event': self.event.pk})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']), {'sponsor', 'category'})
+        response = self.post_json('/api/flows/Income/steps/1', {})
+        self.assertEqual(response.status_code, 403)
+
+
+class HomeCacheTests(FlowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caching.reset_stats()
+
+    def test_fragments_are_cached_until_a_transition(self):
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        call_command('rebuild_workitems', stdout=StringIO())
+        self.client.force_login(self.users[ORGZER])
+        response = self.client.get('/')
+        self.assertContains(response, "Create new Income")
+        self.assertContains(response, "in state have-invoice")
+        with self.assertNumQueries(2):  # session, user (the roles are cached)
+            self.client.get('/')
+        self.assertEqual(caching.get_stats(), {
+            'create_hits': 1, 'create_misses': 1, 'open_hits': 1, 'open_misses': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/flow/create/Income/2/{}'.format(income.pk), {'ready_to_payment': 'true'})
+        response = self.client.get('/')
+        self.assertNotContains(response, "in state have-invoice")
+        self.assertEqual(caching.get_stats(), {
+            'create_hits': 2, 'create_misses': 1, 'open_hits': 1, 'open_misses': 2})
+
+
+class ReportingTests(FlowTestCase):
+
+    def test_counts_and_money(self):
+        other = Sponsor.objects.create(name="Other")
+        paid = self.create_income(Income.S_PAYMENT_DONE)
+        paid.payments_received.create(timestamp=timezone.now(), amount=600)
+        paid.payments_received.create(timestamp=timezone.now(), amount=400)
+        self.create_income(Income.S_INIT)
+        Income.objects.create(
+            state=Income.S_INIT, event=self.event, sponsor=other, category=self.category)
+
+        self.assertEqual(reporting.state_counts(), {
+            'Income': {Income.S_INIT: 2, Income.S_PAYMENT_DONE: 1}})
+        self.assertEqual(reporting.money_totals('event'), [{
+            'id': self.event.pk, 'name': "PyCon", 'incomes': 3, 'expected': 3000,
+            'received': 1000}])
+        by_sponsor = {row['name']: row for row in reporting.money_totals('sponsor')}
+        self.assertEqual(
+            (by_sponsor['ACME']['expected'], by_sponsor['ACME']['received']), (2000, 1000))
+        self.assertEqual(
+            (by_sponsor['Other']['expected'], by_sponsor['Other']['received']), (1000, 0))
+
+    def test_time_in_state(self):
+        start = timezone.now()
+        for pk, minutes in enumerate([10, 20, 30, 40], 1):
+            Transition.objects.create(
+                model='Income', object_pk=pk, to_state=Income.S_INIT, step_index=0,
+                time=start)
+            Transition.objects.create(
+                model='Income', object_pk=pk, from_state=Income.S_INIT,
+                to_state=Income.S_HAVE_INVOICE, step_index=1,
+                time=start + timedelta(minutes=minutes))
+        with self.assertNumQueries(1):
+            report = reporting.time_in_state(Income)
+        self.assertEqual(list(report), [Income.S_INIT])
+        self.assertEqual(report[Income.S_INIT], {
+            'count': 4, 'p50': timedelta(minutes=20), 'p90': timedelta(minutes=40),
+            'p99': timedelta(minutes=40)})
+
+    def test_dashboard_is_cached(self):
+        self.client.force_login(self.users[ADMIN])
+        self.assertEqual(self.client.get('/reports').status_code, 200)
+        with self.assertNumQueries(2):  # session, user (the roles are cached)
+            self.client.get('/reports')
+        self.client.force_login(self.users[ORGZER])
+        self.assertEqual(self.client.get('/reports').status_code, 403)
+
+
+@override_settings(FLOW_METRICS_SAMPLE_RATE=1, FLOW_METRICS_TOKEN='secret-token')
+class MetricsTests(FlowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_step_request_is_measured(self):
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        self.client.force_login(self.users[ORGZER])
+        with self.assertLogs('core.metrics', 'INFO') as logs:
+            self.client.post(
+                '/flow/create/Income/2/{}'.format(income.pk), {'ready_to_payment': 'true'})
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(
+            (record['view'], record['model'], record['step'], record['status']),
+            ('post_flow', 'Income', 2, 302))
+        self.assertGreater(record['db_queries'], 0)
+
+        self.client.get('/flow/create/Income/{}'.format(income.pk))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer secret-token').status_code, 200)
+        self.client.force_login(self.users[ADMIN])
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('flow_requests_total{view="post_flow",model="Income",step="2"} 1', text)
+        self.assertIn('flow_requests_total{view="update_flow",model="Income",step=""} 1', text)
+        self.assertIn('# TYPE flow_template_seconds_total counter', text)
+
+    def test_creation_step_label(self):
+        metrics.add({
+            'view': 'post_new_flow', 'model': 'Income', 'step': 0, 'seconds': 0.1,
+            'db_queries': 1, 'db_seconds': 0.0, 'template_seconds': 0.0, 'cache_hits': 0,
+            'cache_misses': 0})
+        self.assertIn(
+            'flow_requests_total{view="post_new_flow",model="Income",step="0"} 1',
+            metrics.render_prometheus())
+
+    @override_settings(FLOW_METRICS_SAMPLE_RATE=0)
+    def test_disabled(self):
+        self.client.force_login(self.users[ADMIN])
+        self.client.get('/')
+        self.assertNotIn('flow_requests_total{', metrics.render_prometheus())
+
+
+class ImportTests(FlowTestCase):
+
+    def rows(self, text, format='csv'):
+        return importing.read_rows(StringIO(text), format)
+
+    def test_import_is_idempotent(self):
+        results = []
+        for _ in range(2):
+            importer = importing.Importer(batch_size=2)
+            importer.import_events(self.rows("name\nPyCon\nPyDay\nPyDay\n"))
+            importer.import_sponsors(
+                self.rows('{"name": "Initech"}\n\n{"name": "ACME"}\n', 'jsonl'))
+            categories = importer.import_categories(self.rows(
+                "event,name,amount\nPyDay,Gold,500\nPyDay,Silver,200\nPyCon,Gold,1500\n"))
+            incomes = importer.import_incomes(self.rows(
+                "event,sponsor,category,state\nPyDay,Initech,Gold,\n"
+                "PyDay,ACME,Silver,have-invoice\nPyCon,ACME,Gold,\nPyDay,ACME,Bronze,\n"
+                "PyCon,Initech,Gold,bogus\n"))
+            results.append((categories, incomes))
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(Sponsor.objects.count(), 2)
+        self.assertEqual(results[0][0], (2, 1, 0, {}))
+        self.assertEqual(results[1][0], (0, 0, 3, {}))
+        self.assertEqual(Category.objects.get(pk=self.category.pk).amount, 1500)
+        self.assertEqual(results[0][1].created, 3)
+        self.assertEqual(results[1][1].unchanged, 3)
+        self.assertEqual(incomes.failed, {
+            5: "unknown category 'Bronze' for the event", 6: "invalid state 'bogus'"})
+        self.assertEqual(
+            sorted(Income.objects.values_list('state', flat=True)),
+            [Income.S_HAVE_INVOICE, Income.S_INIT, Income.S_INIT])
+        self.assertEqual(
+            set(Transition.objects.values_list('from_state', 'step_index')), {(None, 0)})
+        self.assertEqual(WorkItem.objects.count(), 3)
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_unreadable_lines_fail_alone(self):
+        result = importing.Importer(batch_size=2).import_sponsors(self.rows(
+            '{"name": "Initech"}\n{"name": \n[1, 2]\n{"name": "Globex"}\n', 'jsonl'))
+        self.assertEqual((result.created, sorted(result.failed)), (2, [2, 3]))
+        self.assertEqual(result.failed[3], "not a JSON object")
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as fh:
+            fh.write("name\nPyDay\n\n")
+            fh.flush()
+            out = StringIO()
+            call_command('import_data', 'events', fh.name, stdout=out)
+        self.assertIn("1 created, 0 updated, 0 unchanged, 0 failed", out.getvalue())
+
+
+class ExportTests(FlowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.incomes = [
+            self.create_income(state) for state in (Income.S_INIT, Income.S_PAYMENT_DONE)]
+        transitions.record_transitions(Income, [
+            (income.pk, None, income.state, 0) for income in self.incomes], self.users[ORGZER])
+        self.incomes[1].payments_received.create(timestamp=timezone.now(), amount=1000)
+
+    def test_flows_view(self):
+        self.client.force_login(self.users[ADMIN])
+        response = self.client.get('/export/flows?model=Income&state=payment-done')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], (
+            "pk,state,event,sponsor,category,category_amount,invoice_kind,invoice_date,"
+            "invoice_amount,total_received,created"))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(
+            "{},payment-done,PyCon,ACME,Gold,1000.00,,,,1000.00,".format(self.incomes[1].pk)))
+
+        today = timezone.now().date()
+        response = self.client.get('/export/flows?model=Income&since={}'.format(
+            today + timedelta(days=1)))
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1)
+        self.assertEqual(self.client.get('/export/flows?model=Income&since=x').status_code, 400)
+        self.assertEqual(self.client.get('/export/flows').status_code, 400)
+        self.client.force_login(self.users[ORGZER])
+        self.assertEqual(self.client.get('/export/history').status_code, 403)
+
+    def test_history_command(self):
+        out = StringIO()
+        call_command('export_data', 'history', '--format', 'jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['pk'] for row in rows], [income.pk for income in self.incomes])
+        self.assertEqual(rows[0]['user'], ORGZER)
+
+
+@override_settings(FLOW_DERIVATIVE_WORKERS=0)
+class StorageTests(FlowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'PNG')
+        self.png = buffer.getvalue()
+
+    def create_invoice(self, filename):
+        return Invoice.objects.create(
+            date=timezone.now(), kind='A', amount=1000,
+            image=SimpleUploadedFile(filename, self.png))
+
+    def test_same_content_is_stored_once(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            first = self.create_invoice('scan.png')
+            second = self.create_invoice('scan-again.PNG')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(first.image.name.startswith('blobs/'))
+        self.assertEqual(len(callbacks), 1)
+        blobs = storage.blob_storage.path(storage.BLOBS_DIR)
+        self.assertFalse([name for name in os.listdir(blobs) if name.startswith('.upload-')])
+        thumb_name = storage.derivative_name(first.image.name, 'thumb')
+        with Image.open(storage.blob_storage.open(thumb_name)) as thumb:
+            self.assertEqual(thumb.size, (160, 80))
+
+    def test_update_page_shows_thumbnails(self):
+        invoice = self.create_invoice('scan.png')
+        income = self.create_income(Income.S_HAVE_INVOICE)
+        Income.objects.filter(pk=income.pk).update(invoice=invoice)
+        self.client.force_login(self.users[ORGZER])
+        response = self.client.get('/flow/create/Income/{}'.format(income.pk))
+        # the derivatives are not made until the upload is committed
+        self.assertContains(response, '<img src="/media/{}">'.format(invoice.image.name))
+
+        storage.make_derivatives(invoice.image.name)
+        response = self.client.get('/flow/create/Income/{}'.format(income.pk))
+        self.assertContains(response, '<img src="/media/{}">'.format(
+            storage.derivative_name(invoice.image.name, 'thumb')))
+        self.assertNotContains(response, invoice.image.name)
+
+
+class ArchiveTests(FlowTestCase):
+
+    def finish(self, income, days_ago):
+        Transition.objects.create(
+            model='Income', object_pk=income.pk, from_state=Income.S_READY_TO_PAYMENT,
+            to_state=income.state, step_index=3, user=self.users[ADMIN],
+            time=timezone.now() - timedelta(days=days_ago))
+
+    def test_archive_old_finished_flows(self):
+        old = [self.create_income(Income.S_PAYMENT_DONE) for _ in range(3)]
+        for income in old:
+            self.finish(income, 400)
+            income.payments_received.create(timestamp=timezone.now(), amount=1000)
+        old[0].extra_docs.add(ExtraDocument.objects.create(image='doc.png', comment="Receipt"))
+        recent = self.create_income(Income.S_PAYMENT_DONE)
+        self.finish(recent, 10)
+        open_income = self.create_income(Income.S_INIT)
+
+        out = StringIO()
+        call_command('archive_flows', '--batch-size', '2', '--max-batches', '1', stdout=out)
+        self.assertIn("Archived 2 incomes.", out.getvalue())
+        call_command('archive_flows', '--batch-size', '2', stdout=out)
+        self.assertEqual(
+            set(Income.objects.values_list('pk', flat=True)), {recent.pk, open_income.pk})
+        self.assertEqual(PaymentReceived.objects.count(), 0)
+        self.assertEqual(Transition.objects.count(), 1)
+
+        archived = IncomeArchive.objects.get(pk=old[0].pk)
+        self.assertEqual(archived.total_received, 1000)
+        self.assertEqual(archived.payments_received.get().amount, 1000)
+        self.assertEqual(archived.extra_docs.get().comment, "Receipt")
+        self.assertEqual(
+            TransitionArchive.objects.filter(object_pk=old[0].pk).get().user, self.users[ADMIN])
+        rows = IncomeArchive.objects.union_hot('pk', 'state', sponsor=self.sponsor)
+        self.assertEqual(sorted((row['pk'], row['is_archived']) for row in rows), [
+            (old[0].pk, True), (old[1].pk, True), (old[2].pk, True),
+            (recent.pk, False), (open_income.pk, False)])
+        with self.assertRaises(TypeError):
+            IncomeArchive.objects.all().delete()
+        with self.assertRaises(TypeError):
+            archived.save()
+        for related in (self.sponsor, self.event, archived.extra_docs.get()):
+            with self.assertRaises(ProtectedError):
+                related.delete()
+        self.assertEqual(IncomeArchive.objects.count(), 3)
+        self.assertEqual(PaymentArchive.objects.count(), 3)
+
+
+class RolesTests(FlowTestCase):
+
+    def test_roles_are_cached_until_changed(self):
+        user = self.users[ORGZER]
+        self.assertEqual(roles.get_roles(user), {ORGZER})
+        with self.assertNumQueries(0):
+            self.assertEqual(roles.get_roles(user), {ORGZER})
+
+        admins = Group.objects.create(name=ADMIN)
+        user.groups.add(admins)
+        self.assertEqual(roles.get_roles(user), {ORGZER, ADMIN})
+        admins.user_set.clear()
+        self.assertEqual(roles.get_roles(user), {ORGZER})
+        user.profile.security_clearance = ADMIN
+        user.profile.save()
+        self.assertEqual(roles.get_roles(user), {ADMIN})
+
+    def test_anonymous_users_cant_see_flows(self):
+        income = self.create_income()
+        for url in ('/flow/create/Income', '/flow/create/Income/{}'.format(income.pk)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response['Location'].startswith('/accounts/login/'))
+
+    def test_several_roles(self):
+        income = self.create_income(Income.S_INIT)
+        call_command('rebuild_workitems', stdout=StringIO())
+        user = self.users[ORGZER]
+        user.groups.add(Group.objects.create(name=ADMIN))
+        self.client.force_login(user)
+        response = self.client.get('/')
+        self.assertContains(response, "Create new Income")
+        self.assertContains(response, "in state init")
+        response = self.client.get('/flow/create/Income/{}'.format(income.pk))
+        self.assertEqual(
+            [info['url'] for info in response.context['forms']],
+            ['/flow/create/Income/1/{}'.format(income.pk)])
+
+
+class SearchTests(FlowTestCase):
+
+    def test_documents_follow_the_changes(self):
+        income = Income.objects.create(
+            state=Income.S_INIT, event=self.event, sponsor=self.sponsor, category=self.category)
+        other = Income.objects.create(
+            state=Income.S_INIT, event=Event.objects.create(name="EuroPython"),
+            sponsor=self.sponsor, category=self.category)
+        self.assertEqual([pk for pk, _ in search.search(Income, "pyc")], [income.pk])
+        self.assertEqual([pk for pk, _ in search.search(Income, "acm gol")], [income.pk, other.pk])
+
+        # the invoice is set with an UPDATE, by the step
+        invoice = Invoice.objects.create(
+            date=timezone.now(), kind='B', amount=1234, image='invoice.png')
+        transitions.bulk_apply_step(
+            Income.objects.filter(pk=income.pk), Income.get_step_by_index(1),
+            {'invoice': invoice.pk}, self.users[ADMIN])
+        self.assertEqual([pk for pk, _ in search.search(Income, "1234")], [income.pk])
+
+        self.sponsor.name = "Initech"
+        self.sponsor.save()
+        self.assertEqual(search.search(Income, "acme"), [])
+        self.assertEqual(len(search.search(Income, "initech")), 2)
+        other.delete()
+        self.assertEqual([pk for pk, _ in search.search(Income, "init")], [income.pk])
+        self.assertEqual(search.search(Income, '"*'), [])
+
+    def test_rebuild_and_view(self):
+        income = self.create_income()
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM core_search_income')
+        self.assertEqual(search.search(Income, "pycon"), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.client.force_login(self.users[ORGZER])
+        response = self.client.get('/flow/search/Income', {'q': "pycon"})
+        self.assertEqual(
+            [result['url'] for result in response.context['results']],
+            ['/flow/create/Income/{}'.format(income.pk)])
@@ -0,0 +1,231 @@
+"""The only way to move FSM instances from one state to the next.
+
+Everything that must happen when an instance changes state is done here, in the same
+transaction as the change itself.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from core import caching, forms, registry, search
+from core.models import PendingNotification, Transition, WorkItem
+
+# how many rows are inserted per query when recording many transitions together
+BATCH_SIZE = 500
+
+# the outcome of a bulk transition: the pks that were moved, and pk -> why for the others
+BulkResult = namedtuple('BulkResult', "done failed")
+
+# set while the saves are recorded by the code doing them, see recorded_saves()
+_recorded_saves = ContextVar('recorded_saves', default=False)
+
+
+def build_work_items(model, pk, state, since):
+    """Return the (unsaved) WorkItems for an instance that is in the given state."""
+    roles = model._fsm_table.roles_by_state.get(state, ())
+    return [
+        WorkItem(role=role, model=model.__name__, object_pk=pk, state=state, since=since)
+        for role in sorted(roles)]
+
+
+def record_transitions(model, moves, user, notify=True):
+    """Record that some instances of the model changed state.
+
+    The moves are (pk, from_state, to_state, step_index) tuples (step_index None for changes
+    outside the flow), and must be recorded in the same transaction that saved the instances;
+    many moves (e.g. from an import) are written with a few batched queries. With
+    `notify=False` no mails are queued for them.
+    """
+    now = timezone.now()
+    model_name = model.__name__
+    WorkItem.objects.filter(
+        model=model_name, object_pk__in=[pk for pk, _, _, _ in moves]).delete()
+    items = []
+    history = []
+    for pk, from_state, to_state, step_index in moves:
+        items.extend(build_work_items(model, pk, to_state, now))
+        history.append(Transition(
+            model=model_name, object_pk=pk, from_state=from_state, to_state=to_state,
+            step_index=step_index, user=user, time=now))
+    WorkItem.objects.bulk_create(items, batch_size=BATCH_SIZE)
+    Transition.objects.bulk_create(history, batch_size=BATCH_SIZE)
+    if notify:
+        PendingNotification.objects.bulk_create(
+            [PendingNotification(transition=transition) for transition in history],
+            batch_size=BATCH_SIZE)
+    # the steps may have changed the searched fields with an UPDATE, that sends no signals
+    search.update(model, [pk for pk, _, _, _ in moves])
+    transaction.on_commit(caching.bump_open_version)
+
+
+def sync_work_items(model, pk, state):
+    """Make the WorkItems of an instance match its state, if it was changed outside the flow.
+
+    A state None means the instance was deleted.
+    """
+    items = WorkItem.objects.filter(model=model.__name__, object_pk=pk)
+    expected = [] if state is None else build_work_items(model, pk, state, timezone.now())
+    if set(items.values_list('role', 'state')) == {(item.role, item.state) for item in expected}:
+        return
+    items.delete()
+    WorkItem.objects.bulk_create(expected)
+    transaction.on_commit(caching.bump_open_version)
+
+
+@contextmanager
+def recorded_saves():
+    """The FSM instances saved in this block are recorded by the caller (record_transitions).
+
+    So the signal handlers for the saves outside the flow leave them alone.
+    """
+    token = _recorded_saves.set(True)
+    try:
+        yield
+    finally:
+        _recorded_saves.reset(token)
+
+
+def _instance_saved(sender, instance, created, update_fields, **kwargs):
+    # (for the saves outside the flow, like the admin)
+    if _recorded_saves.get():
+        return
+    if created:
+        old_state = None
+    elif update_fields is not None and 'state' not in update_fields:
+        old_state = instance.state
+    elif hasattr(instance, '_fsm_saved_state'):
+        old_state = instance._fsm_saved_state
+    else:
+        # not loaded from the database, its history says where it was
+        old_state = Transition.objects.filter(
+            model=sender.__name__, object_pk=instance.pk,
+        ).order_by('-time', '-pk').values_list('to_state', flat=True).first()
+    if old_state != instance.state:
+        record_transitions(sender, [(instance.pk, old_state, instance.state, None)], None)
+    else:
+        sync_work_items(sender, instance.pk, instance.state)
+        search.update(sender, [instance.pk])
+    instance._fsm_saved_state = instance.state
+
+
+def _instance_deleted(sender, instance, **kwargs):
+    sync_work_items(sender, instance.pk, None)
+    search.update(sender, [instance.pk])
+
+
+def connect():
+    """Keep the WorkItems and search documents of the instances changed outside the flow."""
+    for model in registry.get_models():
+        post_save.connect(_instance_saved, sender=model)
+        post_delete.connect(_instance_deleted, sender=model)
+
+
+class TransitionConflict(Exception):
+    """The instance was changed by somebody else since it was read."""
+
+
+def apply_step(step, form, user, expected_version=None):
+    """Save the (valid) form of the step moving its instance to the step's next state.
+
+    An existing instance is only changed if it's still in the step's current state (and in
+    the expected version, if given), checked in the UPDATE itself so no locks are held;
+    otherwise TransitionConflict is raised and nothing is changed.
+    """
+    with transaction.atomic():
+        obj = form.save(commit=False)
+        model = type(obj)
+        if step.current_state is None:
+            obj.state = step.next_state
+            with recorded_saves():
+                obj.save()
+        else:
+            conditions = {'pk': obj.pk, 'state': step.current_state}
+            if expected_version is not None:
+                conditions['version'] = expected_version
+            values = {}
+            for name in step.fields:
+                field = model._meta.get_field(name)
+                if field.concrete and not field.many_to_many:
+                    values[field.attname] = getattr(obj, field.attname)
+            updated = model.objects.filter(**conditions).update(
+                state=step.next_state, version=F('version') + 1, **values)
+            if not updated:
+                raise TransitionConflict(
+                    "{} {} is not in state {!r} anymore".format(
+                        model.__name__, obj.pk, step.current_state))
+            obj.state = obj._fsm_saved_state = step.next_state
+        form.save_m2m()
+        record_transitions(
+            model, [(obj.pk, step.current_state, step.next_state, step.index)], user)
+    return obj
+
+
+def _bulk_values(model, step, values):
+    """Validate and convert the values for a bulk transition with the step's form.
+
+    So they are checked as in the flow pages: required fields, scopes, and so on.
+    """
+    unknown = set(values) - set(step.fields)
+    if unknown:
+        raise ValueError("Fields not worked in step {}: {}".format(
+            step.index, ", ".join(sorted(unknown))))
+    form = forms.get_step_form_class(model, step.index)(values)
+    for name, field in form.fields.items():
+        if model._meta.get_field(name).many_to_many:
+            raise ValueError("Field {!r} can't be set in a bulk transition".format(name))
+    if not form.is_valid():
+        raise ValueError("Invalid values: {}".format("; ".join(
+            "{}: {}".format(name, " ".join(errors)) for name, errors in form.errors.items())))
+    return {name: form.cleaned_data[name] for name in form.fields}
+
+
+def bulk_apply_step(queryset, step, values, user, batch_size=BATCH_SIZE):
+    """Move all the instances of the queryset through the step, setting the given values.
+
+    Each batch is updated with one conditional UPDATE (and its history, work items and
+    notifications written) in its own transaction. Instances that are not in the step's
+    current state, or whose batch fails, are reported in the result instead of stopping
+    the whole run.
+    """
+    model = queryset.model
+    if step.current_state is None:
+        raise ValueError("Creation steps can't be done in bulk")
+    values = _bulk_values(model, step, values)
+
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    done = []
+    failed = {}
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        try:
+            with transaction.atomic():
+                moved_pks = []
+                for pk, state in model.objects.filter(pk__in=batch).values_list('pk', 'state'):
+                    if state == step.current_state:
+                        moved_pks.append(pk)
+                    else:
+                        failed[pk] = "in state {!r}, the step is for {!r}".format(
+                            state, step.current_state)
+                # all get the same values, so it's a single conditional UPDATE
+                updated = model.objects.filter(
+                    pk__in=moved_pks, state=step.current_state,
+                ).update(state=step.next_state, version=F('version') + 1, **values)
+                if updated != len(moved_pks):
+                    raise TransitionConflict("changed concurrently, retry")
+                record_transitions(model, [
+                    (pk, step.current_state, step.next_state, step.index)
+                    for pk in moved_pks], user)
+        except (DatabaseError, TransitionConflict) as err:
+            for pk in batch:
+                failed.setdefault(pk, "batch failed: {}".format(err))
+            continue
+        done.extend(moved_pks)
+        for pk in set(batch).difference(moved_pks, failed):
+            failed[pk] = "does not exist anymore"
+    return BulkResult(done=done, failed=failed)
@@ -1,114 +1,263 @@
-from django.http import HttpResponseRedirect
-from django.forms import models as model_forms
-from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db.models import CharField, Q, TextField
+from django.forms import Media
+from django.http import (
+    Http404, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
+from django.urls import reverse, reverse_lazy
+from django.utils.safestring import mark_safe
 from django.views.generic.edit import View
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404
 from django.contrib.auth.mixins import LoginRequiredMixin
 
-from core import models
+from core import (
+    caching, exporting, forms, loading, registry, reporting, search, transitions,
+)
+from core.models import ADMIN, Transition, WorkItem
+
+# how many open flows are listed per page in the home page
+OPEN_PAGE_SIZE = 50
+
+# how many options are returned per page when searching related objects for a step form
+LOOKUP_PAGE_SIZE = 20
+
+# the reports are recomputed at most once in this amount of seconds
+REPORTS_TIMEOUT = 60
+REPORTS_CACHE_KEY = 'flow:reports'
 
 
 class HomePage(LoginRequiredMixin, View):
 
     def get(self, request):
-        models_objs = [getattr(models, name) for name in dir(models)]
-        all_fsm_models = []
-        for obj in models_objs:
-            if obj is models.FSMModel:
-                continue
-            if isinstance(obj, type) and issubclass(obj, models.FSMModel):
-                all_fsm_models.append(obj)
-
-        # add create stuff
+        try:
+            page_number = int(request.GET.get('page', 1))
+        except ValueError:
+            page_number = 1
+        create_fragments = []
+        open_fragments = []
+        # the fragments are cached per role, users with several roles get them all
+        for role in sorted(request.roles):
+            create_fragments.append(caching.create_fragment(
+                role, lambda: self.render_create(role)))
+            open_fragments.append(caching.open_fragment(
+                role, page_number, lambda: self.render_open(role, page_number)))
+        context = {
+            'create_fragment': mark_safe(''.join(create_fragments)),
+            'open_fragment': mark_safe(''.join(open_fragments)),
+        }
+        return TemplateResponse(request, 'core/basic_create_list.html', context=context)
+
+    def render_create(self, role):
         create_context = []
-        for model in all_fsm_models:
-            if request.user.profile.security_clearance in model.get_create_roles():
-                model_name = model.__name__
-                create_context.append({
-                    'text': "Create new {}".format(model_name),
-                    'url': reverse_lazy(
-                        'create_flow', kwargs={'fsmmodel': model_name}),
-                })
-
-        # add open stuff
-        open_context = []
-        for model in all_fsm_models:
-            alive_instances = model.objects.exclude(state=model.fsm_final_state).all()
-            for instance in alive_instances:
-                instance_current_steps = instance.get_current_steps(
-                    request.user.profile.security_clearance)
-                if instance_current_steps:
-                    model_name = model.__name__
-                    open_context.append({
-                        'text': "Work on {} in state {}".format(instance, instance.state),
-                        'url': reverse_lazy(
-                            'update_flow', kwargs={'fsmmodel': model_name, 'pk': instance.pk}),
-                    })
+        for model in registry.get_create_models(role):
+            create_context.append({
+                'text': "Create new {}".format(model.__name__),
+                'url': reverse('create_flow', kwargs={'fsmmodel': model}),
+            })
+        return render_to_string('core/home_create.html', {'create': create_context})
 
-        context = {'create': create_context, 'open': open_context}
-        return render(request, 'core/basic_create_list.html', context=context)
+    def render_open(self, role, page_number):
+        work_items = WorkItem.objects.filter(role=role).order_by('since', 'pk')
+        page = Paginator(work_items, OPEN_PAGE_SIZE).get_page(page_number)
+        open_context = []
+        for item in page:
+            open_context.append({
+                'text': "Work on {} object ({}) in state {}".format(
+                    item.model, item.object_pk, item.state),
+                'url': reverse(
+                    'update_flow', kwargs={'fsmmodel': item.model, 'pk': item.object_pk}),
+            })
+        return render_to_string(
+            'core/home_open.html', {'open': open_context, 'open_page': page})
 
 
-class CreateFSMModel(View):
+class CreateFSMModel(LoginRequiredMixin, View):
 
     def get(self, request, fsmmodel, pk=None):
-        print("============= Armar el get fsm model!!", fsmmodel, pk)
-        model = getattr(models, fsmmodel)
+        return self.render_page(request, fsmmodel, pk)
+
+    def render_page(self, request, model, pk, bound_forms=None, status=200):
+        """Render the flow page; `bound_forms` are {step index: form} to show with errors."""
         if pk is None:
             instance_form = None
             current_state = None
             instance_pk = None
         else:
-            instance = model.objects.get(pk=pk)
+            instance = get_object_or_404(loading.detail_queryset(model), pk=pk)
             instance_pk = instance.pk
             current_state = instance.state
-            form_class = model_forms.modelform_factory(model, fields='__all__')
-            instance_form = form_class(instance=instance)
-            for field_value in instance_form.fields.values():
-                field_value.widget.attrs['disabled'] = True
-
-            # # hack
-            # for field_name, field_value in instance_form.fields.items():
-            #     print("=========== revisando", field_name, type(field_name))
-            #     if field_name == 'invoice':  # FIXME: horrible hack
-            #         print("============= always new!!!")
-            #         from core.models import Income
-            #         from core.admin import admin
-            #         rel = OneToOneRel(Income.invoice, 'id', 'invoice')
-            #         instance_form.fields[field_name] = RelatedFieldWidgetWrapper(
-            #             field_value.widget, rel, admin.admin_site)
-
-        steps = model.get_steps(current_state, request.user.profile.security_clearance)
+            instance_form = forms.get_instance_form_class(model)(instance=instance)
+
+        steps = model.get_steps_for_roles(current_state, request.roles)
         context = {'instance_form': instance_form}
+        if instance_pk is not None:
+            context['version'] = instance.version
+            context['totals'] = [
+                (name.replace('_', ' '), getattr(instance, name))
+                for name, _ in loading.get_load_plan(model).totals]
+            context['history_url'] = reverse_lazy(
+                'flow_history', kwargs={'fsmmodel': model, 'pk': instance_pk})
         context['forms'] = []
+        context['media'] = Media()
         for step in steps:
-            form_class = model_forms.modelform_factory(model, fields=step.fields)
-            form = form_class()
-            model_name = model.__name__
-            url_kwargs = {'fsmmodel': model_name, 'pk': instance_pk, 'step_index': step.index}
+            form = (bound_forms or {}).get(step.index)
+            if form is None:
+                form = forms.get_step_form_class(model, step.index)()
+            context['media'] += form.media
+            if instance_pk is None:
+                url = reverse_lazy(
+                    'post_new_flow', kwargs={'fsmmodel': model, 'step_index': step.index})
+            else:
+                url = reverse_lazy('post_flow', kwargs={
+                    'fsmmodel': model, 'step_index': step.index, 'pk': instance_pk})
             context['forms'].append({
                 'form': form,
-                'url': reverse_lazy('post_flow', kwargs=url_kwargs),
+                'url': url,
             })
         if pk is None:
             template = 'core/createform.html'
         else:
             template = 'core/updateform.html'
-        return render(request, template, context=context)
-
-    def post(self, request, fsmmodel, step_index, pk):
-        print("================ PPPPOST", fsmmodel, step_index, pk)
-        model = getattr(models, fsmmodel)
-        step = model.get_step_by_index(int(step_index))
-        form_class = model_forms.modelform_factory(model, fields=step.fields)
-        form = form_class(request.POST)
-        assert form.is_valid()  # FIXME: be polite
-        obj = form.save(commit=False)
-        obj.state = step.next_state
-        obj.save()
+        return TemplateResponse(request, template, context=context, status=status)
+
+    def post(self, request, fsmmodel, step_index, pk=None):
+        model = fsmmodel
+        try:
+            step = model.get_step_by_index(step_index)
+        except IndexError:
+            raise Http404("Unknown step")
+        if step.role not in request.roles:
+            raise PermissionDenied
+        if pk is None:
+            instance = None
+            if step.current_state is not None:
+                raise PermissionDenied
+        else:
+            instance = get_object_or_404(model, pk=pk)
+        form = forms.get_step_form_class(model, step.index)(request.POST, instance=instance)
+        if not form.is_valid():
+            return self.render_page(request, model, pk, {step.index: form}, status=400)
+        try:
+            expected_version = int(request.POST['fsm_version'])
+        except (KeyError, ValueError):
+            expected_version = None
+        try:
+            if instance is not None and instance.state != step.current_state:
+                raise transitions.TransitionConflict(
+                    "{} {} is in state {!r}".format(model.__name__, pk, instance.state))
+            transitions.apply_step(step, form, request.user, expected_version)
+        except transitions.TransitionConflict as err:
+            context = {'message': err, 'url': reverse_lazy(
+                'update_flow', kwargs={'fsmmodel': model, 'pk': pk})}
+            return TemplateResponse(request, 'core/conflict.html', context=context, status=409)
         return HttpResponseRedirect(reverse_lazy('home'))
 
 
+class FlowHistory(LoginRequiredMixin, View):
+
+    def get(self, request, fsmmodel, pk):
+        transitions = Transition.objects.filter(
+            model=fsmmodel.__name__, object_pk=pk).select_related('user').order_by('time', 'pk')
+        context = {'model_name': fsmmodel.__name__, 'pk': pk, 'transitions': transitions}
+        return TemplateResponse(request, 'core/history.html', context=context)
+
+
+class FlowLookup(LoginRequiredMixin, View):
+    """Search the options of a related field of the FSM model's step forms."""
+
+    def get(self, request, fsmmodel, field):
+        worked = {name for step in fsmmodel._fsm_table.steps for name in step.fields}
+        try:
+            db_field = fsmmodel._meta.get_field(field)
+        except FieldDoesNotExist:
+            raise Http404
+        if field not in worked or not db_field.is_relation or not db_field.concrete:
+            raise Http404
+
+        related_model = db_field.related_model
+        queryset = related_model._default_manager.complex_filter(
+            db_field.get_limit_choices_to()).order_by('pk')
+        scope = forms.get_lookup_scopes(fsmmodel).get(field)
+        if scope is not None:
+            remote, local = scope
+            if request.GET.get(local):
+                try:
+                    queryset = queryset.filter(**{remote: request.GET[local]})
+                except (ValueError, ValidationError):
+                    # not a valid option of the scoping field, so there's nothing to limit by
+                    pass
+        query = request.GET.get('q', '').strip()
+        if query:
+            condition = Q(pk__in=[])
+            for text_field in related_model._meta.concrete_fields:
+                if isinstance(text_field, (CharField, TextField)):
+                    condition |= Q(**{text_field.name + '__icontains': query})
+            if query.isdigit():
+                condition |= Q(pk=query)
+            queryset = queryset.filter(condition)
+
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        start = (page - 1) * LOOKUP_PAGE_SIZE
+        # one extra to know if there are more pages, without counting them all
+        objs = list(queryset[start:start + LOOKUP_PAGE_SIZE + 1])
+        results = [{'id': obj.pk, 'text': str(obj)} for obj in objs[:LOOKUP_PAGE_SIZE]]
+        return JsonResponse({'results': results, 'more': len(objs) > LOOKUP_PAGE_SIZE})
+
+
+class FlowSearch(LoginRequiredMixin, View):
+    """The flows of the FSM model found by the words in `q` (by prefix, best first)."""
+
+    def get(self, request, fsmmodel):
+        query = request.GET.get('q', '')
+        context = {
+            'model_name': fsmmodel.__name__,
+            'query': query,
+            'results': [
+                {'pk': pk, 'text': text,
+                 'url': reverse('update_flow', kwargs={'fsmmodel': fsmmodel, 'pk': pk})}
+                for pk, text in search.search(fsmmodel, query)],
+        }
+        return TemplateResponse(request, 'core/search.html', context=context)
+
+
+class ReportsDashboard(LoginRequiredMixin, View):
+
+    def get(self, request):
+        if ADMIN not in request.roles:
+            raise PermissionDenied
+        report = cache.get_or_set(REPORTS_CACHE_KEY, reporting.build_report, REPORTS_TIMEOUT)
+        return TemplateResponse(request, 'core/reports.html', context=report)
+
+
+class DataExport(LoginRequiredMixin, View):
+    """Stream the flows of a model, or the history, as CSV or JSON lines (for accounting)."""
+
+    content_types = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+    def get(self, request, kind):
+        if ADMIN not in request.roles:
+            raise PermissionDenied
+        format = request.GET.get('format', 'csv')
+        if format not in exporting.FORMATS:
+            return HttpResponseBadRequest("Unknown format")
+        try:
+            headers, rows = exporting.get_rows(
+                kind, request.GET.get('model'), request.GET.get('state'),
+                request.GET.get('since'), request.GET.get('until'))
+        except ValueError as err:
+            return HttpResponseBadRequest(str(err))
+        response = StreamingHttpResponse(
+            exporting.encode(headers, rows, format), content_type=self.content_types[format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(kind, format)
+        return response
+
+
 class MagicPapota(View):
 
     def get(self, request):
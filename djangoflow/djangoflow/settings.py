@@ -46,10 +46,18 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.roles.RolesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.metrics.FlowMetricsMiddleware',
 ]
 
+# fraction of the requests measured by FlowMetricsMiddleware (0 disables it); the totals are
+# served at /metrics to the admins, and to requests with this token (for Prometheus, as
+# "Authorization: Bearer <token>"; unset means only the admins)
+FLOW_METRICS_SAMPLE_RATE = 0
+FLOW_METRICS_TOKEN = os.environ.get('DJANGOFLOW_METRICS_TOKEN')
+
 ROOT_URLCONF = 'djangoflow.urls'
 
 TEMPLATES = [
@@ -81,6 +89,25 @@ DATABASES = {
     }
 }
 
+# "SQLite production" mode, for several workers using the database at once (enable it with
+# DJANGOFLOW_SQLITE_PRODUCTION=1): the WAL journal lets the readers go on while somebody
+# writes, the transactions take the write lock when they begin (so they wait for it with
+# the timeout, instead of failing with "database is locked" when upgrading a read lock),
+# and the connections are kept between requests. Measure it with `manage.py load_test`.
+SQLITE_PRODUCTION = {
+    'CONN_MAX_AGE': 600,
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'timeout': 20,
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': (
+            'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA cache_size=-20000; '
+            'PRAGMA temp_store=MEMORY; PRAGMA mmap_size=134217728'),
+    },
+}
+if os.environ.get('DJANGOFLOW_SQLITE_PRODUCTION') == '1':
+    DATABASES['default'].update(SQLITE_PRODUCTION)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -119,3 +146,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Uploaded files (stored by content, see core.storage)
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_URL = '/media/'
+
+# background workers making the images' thumbnails and previews (0 makes them right away)
+FLOW_DERIVATIVE_WORKERS = 2
+
+
+# Flows
+
+# finished flows are moved to the archive tables after these days (manage.py archive_flows)
+FLOW_ARCHIVE_AFTER_DAYS = 365
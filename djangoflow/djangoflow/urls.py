@@ -13,17 +13,50 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, register_converter
 
+import core.api
+import core.converters
+import core.metrics
 import core.views
 
+register_converter(core.converters.FSMModelConverter, 'fsmmodel')
+
 urlpatterns = [
     path('accounts/', include('django.contrib.auth.urls')),
     path('admin/', admin.site.urls),
-    path('flow/create/<fsmmodel>', core.views.CreateFSMModel.as_view(), name='create_flow'),
-    path('flow/create/<fsmmodel>/<pk>', core.views.CreateFSMModel.as_view(), name='update_flow'),
-    path('flow/create/<fsmmodel>/<step_index>/<pk>',
+    path('flow/create/<fsmmodel:fsmmodel>',
+         core.views.CreateFSMModel.as_view(), name='create_flow'),
+    path('flow/create/<fsmmodel:fsmmodel>/<int:pk>',
+         core.views.CreateFSMModel.as_view(), name='update_flow'),
+    path('flow/create/<fsmmodel:fsmmodel>/<int:step_index>/new',
+         core.views.CreateFSMModel.as_view(), name='post_new_flow'),
+    path('flow/create/<fsmmodel:fsmmodel>/<int:step_index>/<int:pk>',
          core.views.CreateFSMModel.as_view(), name='post_flow'),
+    path('flow/history/<fsmmodel:fsmmodel>/<int:pk>',
+         core.views.FlowHistory.as_view(), name='flow_history'),
+    path('flow/search/<fsmmodel:fsmmodel>',
+         core.views.FlowSearch.as_view(), name='flow_search'),
+    path('flow/lookup/<fsmmodel:fsmmodel>/<field>',
+         core.views.FlowLookup.as_view(), name='flow_lookup'),
+    path('api/flows/<fsmmodel:fsmmodel>',
+         core.api.FlowList.as_view(), name='api_flow_list'),
+    path('api/flows/<fsmmodel:fsmmodel>/export',
+         core.api.FlowExport.as_view(), name='api_flow_export'),
+    path('api/flows/<fsmmodel:fsmmodel>/<int:pk>',
+         core.api.FlowDetail.as_view(), name='api_flow_detail'),
+    path('api/flows/<fsmmodel:fsmmodel>/steps/<int:step_index>',
+         core.api.FlowStep.as_view(), name='api_flow_create'),
+    path('api/flows/<fsmmodel:fsmmodel>/<int:pk>/steps/<int:step_index>',
+         core.api.FlowStep.as_view(), name='api_flow_step'),
+    path('reports', core.views.ReportsDashboard.as_view(), name='reports'),
+    path('export/<str:kind>', core.views.DataExport.as_view(), name='data_export'),
+    path('metrics', core.metrics.MetricsView.as_view(), name='metrics'),
     path('', core.views.HomePage.as_view(), name='home'),
 ]
+
+# the uploaded images, when developing (in production the web server serves them)
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)